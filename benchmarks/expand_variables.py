@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""micro-benchmark of Settings.expand_variables on a large Doxyfile template"""
+
+import argparse
+import os
+import re
+import sys
+import tempfile
+import timeit
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source')
+sys.path.insert(0, SOURCE_DIR)
+
+from configure import Settings
+
+
+SETTINGS = '''
+variables:
+  project_name: Benchmark
+  sourcedir:    source
+  builddir:     build
+  projectsdir:  $builddir/projects
+  docsdir:      ${builddir}/doxygen
+compiler:
+  cxx:    g++
+  cflags: -Wall -Wextra
+  lflags: -Wall -Wextra
+'''
+
+
+def legacy_expand(string, variables):
+    """The expansion loop Settings used before the compiled expander"""
+    for key, value in variables.items():
+        string = re.sub(r'(\$\{?%s\}?)' % key, value, string)
+    return string
+
+
+def make_template(size):
+    with open(os.path.join(SOURCE_DIR, 'defaults', 'Doxyfile'), 'r') as fd:
+        template = fd.read()
+    template += 'HTML_OUTPUT = $docsdir/html\nGENERATE_TAGFILE = ${projectsdir}/$project_name.tag\n'
+    return template * (size // len(template) + 1)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument(
+        '--size',
+        metavar='BYTES',
+        type=int,
+        default=4 * 1024 * 1024,
+        help='approximate size of the template')
+    argparser.add_argument(
+        '--repeat',
+        metavar='N',
+        type=int,
+        default=5,
+        help='number of timed runs, the best one is reported')
+    args = argparser.parse_args()
+
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as fd:
+        fd.write(SETTINGS)
+    try:
+        Settings.load(fd.name)
+    finally:
+        os.remove(fd.name)
+
+    template = make_template(args.size)
+    variables = {
+        'project_name': 'Benchmark',
+        'sourcedir': 'source',
+        'builddir': 'build',
+        'projectsdir': 'build/projects',
+        'docsdir': 'build/doxygen',
+        'rootpath': os.path.abspath('.'),
+        'rootdir': os.path.abspath('.'),
+        'cflags': '-Wall -Wextra',
+        'lflags': '-Wall -Wextra'}
+
+    expected = legacy_expand(template, variables)
+    if Settings.expand_variables(template) != expected:
+        print('WARNING: results differ from the legacy expansion')
+
+    print('template: %.1f MB' % (len(template) / (1024.0 * 1024.0)))
+    for name, function in [
+            ('legacy', lambda: legacy_expand(template, variables)),
+            ('compiled', lambda: Settings.expand_variables(template))]:
+        best = min(timeit.repeat(function, number=1, repeat=args.repeat))
+        print('%-10s %8.1f ms' % (name, best * 1000.0))
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""benchmark of parsing target rules files, JSON with comments"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source')
+sys.path.insert(0, SOURCE_DIR)
+
+import util
+
+
+TARGET = '''		{
+			// Target %(index)i, see http://example.com/%(index)i
+			"target_name": "target_%(index)i",
+			"type": "static_library",
+			/* Dependencies of the target,
+			   one per line */
+			"dependencies": [
+				"target_%(previous)i.a",
+				"-lpthread",
+			],
+			"defines": ["TARGET_%(index)i", "NAME=\\"target_%(index)i\\""],
+			"sources": ["src/*.cpp", "src/detail/*.cpp"],
+			"headers": ["include/*.h"],
+			"embedded_data": []
+		}'''
+
+
+def legacy_remove_comments(string):
+    """The comment removal used before the single-pass tokenizer"""
+    pattern = r'(\".*?\"|\'.*?\')|(/\*.*?\*/|//[^\r\n]*$)'
+    regex = re.compile(pattern, re.MULTILINE|re.DOTALL)
+    replacer = lambda match: match.group(1) if match.group(2) is None else ''
+    return regex.sub(replacer, string)
+
+
+def legacy_load(string):
+    yaml = util._import_yaml()
+    return yaml.load(legacy_remove_comments(string).replace('\t', '  '), Loader=yaml.SafeLoader)
+
+
+def make_document(targets):
+    items = [TARGET % {'index': x, 'previous': max(x - 1, 0)} for x in range(targets)]
+    return '{\n\t"targets": [\n%s\n\t]\n}\n' % ',\n'.join(items)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument(
+        '--files',
+        metavar='N',
+        type=int,
+        default=50,
+        help='number of target rules files')
+    argparser.add_argument(
+        '--targets',
+        metavar='N',
+        type=int,
+        default=40,
+        help='targets per file')
+    argparser.add_argument(
+        '--repeat',
+        metavar='N',
+        type=int,
+        default=5,
+        help='number of timed runs, the best one is reported')
+    args = argparser.parse_args()
+
+    corpus = [make_document(args.targets + x) for x in range(args.files)]
+    for document in corpus[:1]:
+        if util.loads_json_with_comments(document) != legacy_load(document):
+            print('WARNING: results differ from the legacy parser')
+
+    yaml = util._import_yaml()
+    modes = [('legacy', legacy_load)]
+    if hasattr(yaml, 'CSafeLoader'):
+        modes.append(('legacy+libyaml', lambda x: yaml.load(
+            legacy_remove_comments(x).replace('\t', '  '), Loader=yaml.CSafeLoader)))
+    modes.append(('tokenizer', util.loads_json_with_comments))
+
+    size = sum(len(x) for x in corpus)
+    print('corpus: %i files, %.1f MB' % (len(corpus), size / (1024.0 * 1024.0)))
+    for name, function in modes:
+        best = min(timeit.repeat(lambda: [function(x) for x in corpus], number=1, repeat=args.repeat))
+        print('%-16s %10.1f ms' % (name, best * 1000.0))
+
+
+if __name__ == '__main__':
+
+    main()
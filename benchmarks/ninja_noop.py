@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""benchmark of ninja's no-op startup with and without deps = gcc"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic import generate_project
+
+
+MODES = [
+    ('depfile', {'cxx': {'deps': None}}),
+    ('deps=gcc', {})]
+
+
+def run(command, cwd):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(command, cwd=cwd, stdout=devnull, stderr=subprocess.STDOUT)
+
+
+def count_files(root, extension):
+    return sum(len([x for x in files if x.endswith(extension)]) for _, _, files in os.walk(root))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--folders', type=int, default=200, help='number of libraries')
+    argparser.add_argument('--files', type=int, default=20, help='sources per library')
+    argparser.add_argument('--headers', type=int, default=100, help='headers per depfile')
+    argparser.add_argument('--repeat', type=int, default=5, help='number of no-op runs')
+    argparser.add_argument('--keep', action='store_true', help='keep the generated projects')
+    argparser.add_argument('configure_pyz_path', help='path to the configure.pyz to benchmark')
+    args = argparser.parse_args()
+
+    configure_pyz = os.path.abspath(args.configure_pyz_path)
+    workdir = tempfile.mkdtemp(prefix='ninja_noop_')
+    try:
+        print('%-10s %10s %12s %14s' % ('mode', 'objects', '.d on disk', 'no-op (ms)'))
+        for name, rules in MODES:
+            root = os.path.join(workdir, name.replace('=', '_'))
+            generate_project(root, args.folders, args.files, args.headers, rules)
+            run([sys.executable, configure_pyz, '--ninja'], root)
+            run(['ninja'], root)
+            timings = []
+            for _ in range(args.repeat):
+                start = time.time()
+                run(['ninja'], root)
+                timings.append(time.time() - start)
+            print('%-10s %10i %12i %14.1f' % (
+                name,
+                count_files(os.path.join(root, 'build'), '.o'),
+                count_files(os.path.join(root, 'build'), '.d'),
+                min(timings) * 1000.0))
+    finally:
+        if args.keep:
+            print('projects kept in %s' % workdir)
+        else:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""benchmark suite of configure.pyz on a synthetic large project
+
+Times cold and warm configure runs, per phase with --trace if supported, the
+size of the generated files, the peak RSS of configure and ninja's no-op run.
+Results of several builds of configure.pyz are saved as JSON and compared
+side by side, saved results may be compared later with --compare."""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic import generate_project
+
+
+GENERATED_FILES = ['build.ninja', 'Makefile']
+
+# Files left by configure.pyz that a cold run must not find.
+CACHE_PATHS = ['build', '.configure.pyz.cache']
+
+
+def run(command, cwd):
+    """Run command in cwd, returns wall time in seconds and peak RSS in KB"""
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        process = subprocess.Popen(command, cwd=cwd, stdout=devnull, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+    if status != 0:
+        raise subprocess.CalledProcessError(status, command)
+    # ru_maxrss is in bytes on macOS.
+    rss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    return seconds, rss
+
+
+def supports_trace(configure_pyz):
+    output = subprocess.check_output([sys.executable, configure_pyz, '--help'])
+    return b'--trace' in output
+
+
+def read_phases(trace_file):
+    """Total milliseconds of each span, and the counters, of a trace"""
+    with open(trace_file, 'r') as fd:
+        events = json.load(fd)['traceEvents']
+    phases = {}
+    counters = {}
+    for event in events:
+        if event['ph'] == 'X':
+            phases[event['name']] = phases.get(event['name'], 0.0) + event['dur'] / 1000.0
+        elif event['ph'] == 'C':
+            counters.update(event['args'])
+    return phases, counters
+
+
+def configure(configure_pyz, root, trace):
+    command = [sys.executable, configure_pyz, '--ninja', '--makefile']
+    trace_file = os.path.join(root, 'trace.json')
+    if trace:
+        command += ['--trace', trace_file]
+    seconds, rss = run(command, root)
+    result = {'ms': seconds * 1000.0, 'rss_kb': rss}
+    if trace:
+        result['phases'], result['counters'] = read_phases(trace_file)
+    return result
+
+
+def benchmark(configure_pyz, root, repeat):
+    for path in CACHE_PATHS + GENERATED_FILES:
+        path = os.path.join(root, path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+    trace = supports_trace(configure_pyz)
+    results = {'cold': configure(configure_pyz, root, trace)}
+    # Best of the warm runs.
+    warm = [configure(configure_pyz, root, trace) for _ in range(repeat)]
+    results['warm'] = min(warm, key=lambda x: x['ms'])
+    results['files'] = dict(
+        (x, os.path.getsize(os.path.join(root, x)))
+        for x in GENERATED_FILES if os.path.isfile(os.path.join(root, x)))
+    run(['ninja'], root)
+    results['ninja_noop_ms'] = min(run(['ninja'], root)[0] for _ in range(repeat)) * 1000.0
+    return results
+
+
+def print_table(runs):
+    """Side by side comparison of the results of each build"""
+    names = [x['configure_pyz'] for x in runs]
+    rows = []
+    for mode in ['cold', 'warm']:
+        rows.append(('%s (ms)' % mode, [x[mode]['ms'] for x in runs]))
+        rows.append(('%s peak RSS (KB)' % mode, [x[mode]['rss_kb'] for x in runs]))
+        phases = set()
+        for result in runs:
+            phases.update(result[mode].get('phases', {}))
+        for phase in sorted(phases):
+            rows.append(('  %s %s (ms)' % (mode, phase),
+                         [x[mode].get('phases', {}).get(phase) for x in runs]))
+    counters = set()
+    for result in runs:
+        counters.update(result['cold'].get('counters', {}))
+    for counter in sorted(counters):
+        rows.append((counter, [x['cold'].get('counters', {}).get(counter) for x in runs]))
+    for filename in GENERATED_FILES:
+        rows.append(('%s (bytes)' % filename, [x['files'].get(filename) for x in runs]))
+    rows.append(('ninja no-op (ms)', [x['ninja_noop_ms'] for x in runs]))
+    for index, name in enumerate(names):
+        print('[%i] %s' % (index, name))
+    header = '%-36s' % 'measure' + ''.join('%14s' % ('[%i]' % x) for x in range(len(names)))
+    if len(names) > 1:
+        header += '%10s' % 'ratio'
+    print(header)
+    for label, values in rows:
+        line = '%-36s' % label
+        line += ''.join('%14s' % ('-' if x is None else '%.1f' % x) for x in values)
+        if len(values) > 1 and values[0] and values[-1] is not None:
+            line += '%10.2f' % (float(values[-1]) / values[0])
+        print(line)
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--folders', type=int, default=200, help='number of libraries')
+    argparser.add_argument('--files', type=int, default=20, help='sources per library')
+    argparser.add_argument('--headers', type=int, default=50, help='headers per depfile')
+    argparser.add_argument(
+        '--rules-ratio', type=float, default=0.5,
+        help='fraction of the libraries with a targets.json')
+    argparser.add_argument(
+        '--fan-out', type=int, default=4,
+        help='dependencies of each library with a targets.json')
+    argparser.add_argument(
+        '--embedded-bytes', type=int, default=0,
+        help='size of the file embedded by every library, none if 0')
+    argparser.add_argument('--repeat', type=int, default=3, help='number of warm runs')
+    argparser.add_argument('--output', metavar='FILE', help='save the results as JSON to FILE')
+    argparser.add_argument(
+        '--compare', nargs='+', metavar='FILE',
+        help='print the results saved in FILEs instead of running')
+    argparser.add_argument('--keep', action='store_true', help='keep the generated project')
+    argparser.add_argument(
+        'configure_pyz_paths', nargs='*', metavar='configure_pyz_path',
+        help='paths to the builds of configure.pyz to benchmark')
+    args = argparser.parse_args()
+
+    if args.compare:
+        runs = []
+        for filepath in args.compare:
+            with open(filepath, 'r') as fd:
+                runs += json.load(fd)['runs']
+        print_table(runs)
+        return
+    if not args.configure_pyz_paths:
+        argparser.error('nothing to benchmark')
+
+    parameters = dict((x, getattr(args, x)) for x in [
+        'folders', 'files', 'headers', 'rules_ratio', 'fan_out', 'embedded_bytes'])
+    workdir = tempfile.mkdtemp(prefix='configure_suite_')
+    try:
+        root = os.path.join(workdir, 'project')
+        generate_project(root, **parameters)
+        runs = []
+        for path in args.configure_pyz_paths:
+            result = benchmark(os.path.abspath(path), root, args.repeat)
+            result['configure_pyz'] = path
+            runs.append(result)
+    finally:
+        if args.keep:
+            print('project kept in %s' % workdir)
+        else:
+            shutil.rmtree(workdir)
+    print_table(runs)
+    if args.output is not None:
+        with open(args.output, 'w') as fd:
+            json.dump({'parameters': parameters, 'runs': runs}, fd, indent=2, sort_keys=True)
+        print('results saved to %s' % args.output)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,129 @@
+"""Generate synthetic configure.pyz projects for benchmarking"""
+
+import json
+import os
+import stat
+
+
+FAKE_CXX = '''#!/bin/sh
+# Fake compiler: touches its output and writes a depfile listing every header.
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -MF) depfile="$2"; shift ;;
+    -o) out="$2"; shift ;;
+    -c) src="$2"; shift ;;
+  esac
+  shift
+done
+mkdir -p "$(dirname "$out")"
+: > "$out"
+if [ -n "$depfile" ]; then
+  printf '%%s: %%s %s\\n' "$out" "$src" > "$depfile"
+fi
+'''
+
+SETTINGS = '''variables:
+  project_name: synthetic
+  sourcedir:    source
+  builddir:     build
+  projectsdir:  projects
+
+compiler:
+  cxx:      %(cxx)s
+  cflags:   -Wall
+  lflags:   -Wall
+  includes: [$sourcedir]
+  defines:  []
+
+configurations:
+  - name: release
+    bin:  $builddir/bin_release
+    lib:  $builddir/lib_release
+    obj:  $builddir/obj_release
+    cflags:  -O2
+
+targets:
+  filename: targets.json
+  defaults:
+    type:          static_library
+    dependencies:  []
+    defines:       []
+    include_dirs:  []
+    sources:       ["*.cpp", "*.cc"]
+    headers:       ["*.hpp", "*.h"]
+    embedded_data: []
+    unused:        []
+
+ninja:
+  filename: build.ninja
+  add_default_rules: true
+  include_file: null
+  rules: %(rules)s
+
+makefile:
+  filename: Makefile
+
+doxygen:
+  doxyfile_template: null
+
+sublime:
+  project_template: null
+
+codeblocks:
+  compiler_name: gcc
+'''
+
+
+def _write(filepath, content):
+    directory = os.path.dirname(filepath)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filepath, 'w') as fd:
+        fd.write(content)
+
+
+def generate_project(root, folders=100, files=10, headers=50, rules=None, fake_compiler=True,
+                     rules_ratio=0.0, fan_out=0, embedded_bytes=0):
+    """Write a project of static libraries, each with files sources, and an
+    executable linking all of them. With fake_compiler every object depends
+    on the same headers through its depfile.
+
+    A rules_ratio fraction of the libraries have a targets.json, depending on
+    the fan_out libraries before them. With embedded_bytes every library has
+    a targets.json embedding a file of that size."""
+    header_paths = ['source/include/header_%i.h' % i for i in range(headers)]
+    for path in header_paths:
+        _write(os.path.join(root, path), '#pragma once\n')
+    rules = dict(rules or {})
+    cxx = 'g++'
+    if fake_compiler:
+        cxx = os.path.join(os.path.abspath(root), 'fake_cxx.sh')
+        _write(cxx, FAKE_CXX % ' '.join(header_paths))
+        os.chmod(cxx, os.stat(cxx).st_mode | stat.S_IEXEC)
+        # Empty objects cannot be archived, let the fake compiler do it.
+        rules.setdefault('ar', {'command': '$cxx -o $out'})
+    # JSON is valid YAML.
+    _write(os.path.join(root, 'configure.yaml'), SETTINGS % {'cxx': cxx, 'rules': json.dumps(rules)})
+    libraries = []
+    with_rules = 0
+    for folder in range(folders):
+        name = 'lib_%i' % folder
+        path = os.path.join(root, 'source', name)
+        for index in range(files):
+            source = 'int %s_%i() { return %i; }\n' % (name, index, index)
+            _write(os.path.join(path, 'file_%i.cpp' % index), source)
+        target = {}
+        # Spread evenly, folder gets rules when the integer part increases.
+        if int((folder + 1) * rules_ratio) > with_rules:
+            with_rules += 1
+            target['dependencies'] = libraries[-fan_out:] if fan_out else []
+        if embedded_bytes:
+            _write(os.path.join(path, 'data', 'blob.bin'), 'x' * embedded_bytes)
+            target['embedded_data'] = ['data/*']
+        if target:
+            _write(os.path.join(path, 'targets.json'), json.dumps({'targets': [target]}, indent=2))
+        libraries.append(name + '.a')
+    _write(os.path.join(root, 'source', 'app', 'main.cpp'), 'int main() { return 0; }\n')
+    targets = '{"targets": [{"target_name": "app", "type": "executable", "dependencies": [%s]}]}\n'
+    _write(os.path.join(root, 'source', 'app', 'targets.json'),
+           targets % ', '.join('"%s"' % x for x in libraries))
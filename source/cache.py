@@ -0,0 +1,248 @@
+# configure.pyz Copyright (C) 2014 N. Subiron Montoro
+#
+# This program comes with ABSOLUTELY NO WARRANTY. This is free software, and you
+# are welcome to redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+
+"""On-disk caches of the source tree scan and of parsed documents"""
+
+import hashlib
+import json
+import logging
+import marshal
+import os
+import shutil
+import tempfile
+
+import util
+
+
+CACHE_VERSION = 2
+
+DOCUMENT_CACHE_VERSION = 1
+
+
+def file_digest(filepath):
+    with open(filepath, 'rb') as fd:
+        return hashlib.sha1(fd.read()).hexdigest()
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class ScanCache(object):
+    """Directory listings and targets found on each folder of the source tree.
+
+    An entry is reused as long as the mtime of its folder, the mtime of every
+    subfolder its patterns looked into, and the contents of its target rules
+    file are unchanged. Without filepath it is kept in memory only."""
+
+    def __init__(self, filepath, key):
+        self.filepath = filepath
+        self._key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self._entries = {}
+        self._visited = {}
+        self._inputs = []
+        self._hits = 0
+        if filepath is not None:
+            self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.filepath):
+            return
+        with open(self.filepath, 'r') as fd:
+            try:
+                data = json.load(fd)
+            except ValueError as exception:
+                logging.warning('Ignoring scan cache %s: %s', self.filepath, exception)
+                return
+        if data.get('version') != CACHE_VERSION or data.get('key') != self._key:
+            logging.info('Scan cache out of date: %s', self.filepath)
+            return
+        self._entries = data['directories']
+
+    def save(self):
+        logging.info('Scan cache: %i of %i folders reused', self._hits, len(self._visited))
+        if self.filepath is None or self._visited == self._entries:
+            return
+        data = {'version': CACHE_VERSION, 'key': self._key, 'directories': self._visited}
+        directory = os.path.dirname(self.filepath) or '.'
+        util.mkdir_p(directory)
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as tempf:
+            json.dump(data, tempf, separators=(',', ':'))
+        shutil.move(tempf.name, self.filepath)
+
+    def get_inputs(self):
+        """Folders walked and target rules files found so far, relative to
+        the root and in walk order"""
+        return list(self._inputs)
+
+    def walk(self, root):
+        """Depth-first walk yielding sorted relative paths and files, reusing
+        the listing of unchanged folders."""
+        stack = ['']
+        while stack:
+            relpath = stack.pop()
+            path = os.path.join(root, relpath)
+            mtime = _mtime(path)
+            if mtime is None:
+                continue
+            entry = self._entries.get(relpath)
+            if entry is not None and entry['mtime'] == mtime:
+                dirs, files = entry['dirs'], entry['files']
+            else:
+                dirs, files = util.listdir(path)
+            self._visited[relpath] = {'mtime': mtime, 'dirs': dirs, 'files': files}
+            self._inputs.append(relpath)
+            stack.extend(os.path.join(relpath, x) for x in reversed(dirs))
+            yield relpath, files
+
+    def get_targets(self, root, relpath, rules_filepath):
+        """Return the raw data of the targets cached for relpath, or None."""
+        if rules_filepath is not None:
+            self._inputs.append(os.path.relpath(rules_filepath, root))
+        visited = self._visited[relpath]
+        entry = self._entries.get(relpath)
+        if entry is None or entry['mtime'] != visited['mtime'] or 'targets' not in entry:
+            return None
+        rules = entry['rules']
+        if rules_filepath is None:
+            if rules is not None:
+                return None
+        elif rules is None:
+            return None
+        else:
+            stat = os.stat(rules_filepath)
+            if [stat.st_mtime, stat.st_size] != rules[:2]:
+                if file_digest(rules_filepath) != rules[2]:
+                    return None
+                rules = [stat.st_mtime, stat.st_size, rules[2]]
+        for subdir, mtime in entry['subdirs'].items():
+            if _mtime(os.path.join(root, relpath, subdir)) != mtime:
+                return None
+        visited.update(rules=rules, subdirs=entry['subdirs'], targets=entry['targets'])
+        self._hits += 1
+        return entry['targets']
+
+    def set_targets(self, root, relpath, rules_filepath, targets):
+        visited = self._visited[relpath]
+        subdirs = set()
+        for target in targets:
+            if target.subdirs is None:
+                return
+            subdirs.update(target.subdirs)
+        if rules_filepath is not None:
+            stat = os.stat(rules_filepath)
+            rules = [stat.st_mtime, stat.st_size, file_digest(rules_filepath)]
+        else:
+            rules = None
+        path = os.path.join(root, relpath)
+        visited['rules'] = rules
+        visited['subdirs'] = dict((x, _mtime(os.path.join(path, x))) for x in subdirs)
+        visited['targets'] = [x.raw for x in targets]
+
+
+class DocumentCache(object):
+    """Parsed settings, target rules and resource files, stored with marshal.
+
+    A file is parsed again only if its size or mtime changed and its content
+    did too. The whole cache is discarded when key changes, it must identify
+    the program and the Python version as both resources and the marshal
+    format depend on them. Documents parsed in worker processes are not kept.
+    Callers get their own copy of each document and may modify it."""
+
+    def __init__(self, filepath, key):
+        self.filepath = filepath
+        self._key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self._entries = {}
+        self._changed = False
+        self._hits = 0
+        self._misses = 0
+        if filepath is not None:
+            self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.filepath):
+            return
+        try:
+            with open(self.filepath, 'rb') as fd:
+                data = marshal.loads(fd.read())
+        except (EOFError, ValueError, TypeError) as exception:
+            logging.warning('Ignoring document cache %s: %s', self.filepath, exception)
+            return
+        if not isinstance(data, dict) or data.get('version') != DOCUMENT_CACHE_VERSION \
+                or data.get('key') != self._key:
+            logging.info('Document cache out of date: %s', self.filepath)
+            return
+        self._entries = data['documents']
+
+    def _store(self, name, entry):
+        try:
+            # Only the core types can be stored, YAML may have more.
+            entry = marshal.loads(marshal.dumps(entry))
+        except ValueError:
+            return
+        self._entries[name] = entry
+        self._changed = True
+
+    @staticmethod
+    def _copy(document):
+        return marshal.loads(marshal.dumps(document))
+
+    def load(self, filepath, parse):
+        """Document of filepath, parse(filepath) if not cached"""
+        name = os.path.abspath(filepath)
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return parse(filepath)
+        entry = self._entries.get(name)
+        digest = None
+        if entry is not None:
+            if [stat.st_mtime, stat.st_size] == entry[:2]:
+                self._hits += 1
+                return self._copy(entry[3])
+            digest = file_digest(filepath)
+            if digest == entry[2]:
+                self._hits += 1
+                self._store(name, [stat.st_mtime, stat.st_size, digest, entry[3]])
+                return self._copy(entry[3])
+        self._misses += 1
+        document = parse(filepath)
+        self._store(name, [stat.st_mtime, stat.st_size, digest or file_digest(filepath), document])
+        return document
+
+    def load_resource(self, filename, parse):
+        """Document of the resource filename, parse(filename) if not cached"""
+        name = 'resource:' + filename
+        if name in self._entries:
+            self._hits += 1
+            return self._copy(self._entries[name])
+        self._misses += 1
+        document = parse(filename)
+        self._store(name, document)
+        return document
+
+    def get(self, name):
+        """Value stored with put, None if missing"""
+        return self._entries.get('value:' + name)
+
+    def put(self, name, value):
+        self._store('value:' + name, value)
+
+    def save(self):
+        logging.info('Document cache: %i of %i documents reused',
+                     self._hits, self._hits + self._misses)
+        if self.filepath is None or not self._changed:
+            return
+        data = {'version': DOCUMENT_CACHE_VERSION, 'key': self._key, 'documents': self._entries}
+        directory = os.path.dirname(self.filepath) or '.'
+        util.mkdir_p(directory)
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as tempf:
+            tempf.write(marshal.dumps(data))
+        shutil.move(tempf.name, self.filepath)
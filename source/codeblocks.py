@@ -12,12 +12,18 @@ import platform
 import xml.dom.minidom as minidom
 import xml.etree.cElementTree as ElementTree
 
+from configure import EMBEDDED_DATA_DIR
+from configure import EMBEDDED_DATA_FILES
 from configure import Path
 
 import util
 
 EXECUTABLE_EXT = '.exe' if platform.system().lower() == 'windows' else ''
 
+# Precompiled header generated alongside the header file.
+PCH_MODE = '2'
+PCH_UNIT_OPTIONS = [{'compile': '1'}, {'weight': '0'}]
+
 class CodeBlocks(object):
     """Helper class"""
 
@@ -101,21 +107,43 @@ class CodeBlocksProject(XmlFile):
     def add_variable(self, name, value):
         subelement('Variable', self.environment, {'name': name, 'value': value})
 
-    def add_file(self, filename):
-        subelement('Unit', self.project, {'filename': filename})
+    def add_option(self, dictionary):
+        subelement('Option', self.project, dictionary)
+
+    def add_file(self, filename, options=[]):
+        unit = subelement('Unit', self.project, {'filename': filename})
+        for option in options:
+            subelement('Option', unit, option)
 
 
 def create_base_project(target, codeblocks):
     project = CodeBlocksProject(target['target_name'], codeblocks.compiler_name)
     for name in ['builddir', 'sourcedir']:
       project.add_variable(name, codeblocks.makepath('$' + name))
-    for filename in target['sources'] + target['headers']:
+    pch = target.get('precompiled_header')
+    if pch:
+      project.add_option({'pch_mode': PCH_MODE})
+    headers = [x for x in target['headers'] if x != pch]
+    for filename in target['sources'] + headers:
       project.add_file(codeblocks.makepath('$sourcedir', filename))
+    if pch:
+      project.add_file(codeblocks.makepath('$sourcedir', pch), PCH_UNIT_OPTIONS)
+    if target['embedded_data']:
+      project.add_file(codeblocks.makepath(EMBEDDED_DATA_DIR, target.path, EMBEDDED_DATA_FILES[0]))
     return project
 
+def get_compiler_options(target, compiler, codeblocks, config):
+    options = [codeblocks.cflags, config.cflags, compiler.get_compiler_flags(target.raw)]
+    if target.get('precompiled_header'):
+      options.append('-include ' + codeblocks.makepath('$sourcedir', target['precompiled_header']))
+    if target['embedded_data']:
+      options.append('-I' + codeblocks.makepath(EMBEDDED_DATA_DIR, target.path))
+    return options
+
 def create_library(target, compiler, codeblocks):
     project = create_base_project(target, codeblocks)
     title = target['target_name']
+    shared = target['type'] == 'shared_library'
     for config in codeblocks.configurations:
       build_target = project.add_target(title + ' - ' + config.name)
       outlib = codeblocks.makepath(config.lib, title)
@@ -125,11 +153,13 @@ def create_library(target, compiler, codeblocks):
       build_target.add_option(output)
       build_target.add_option({'working_dir': ''})
       build_target.add_option({'object_output': codeblocks.makepath(config.obj)})
-      build_target.add_option({'type': '2'})
+      build_target.add_option({'type': '3' if shared else '2'})
       build_target.add_option({'compiler': codeblocks.compiler_name})
       build_target.add_option({'createDefFile': '1'})
-      cflags = compiler.get_compiler_flags(target.raw)
-      build_target.add_compiler([codeblocks.cflags, config.cflags, cflags])
+      options = get_compiler_options(target, compiler, codeblocks, config)
+      build_target.add_compiler(options + ['-fPIC'] if shared else options)
+      if shared:
+        add_linker(build_target, target, compiler, codeblocks, config)
     return project
 
 def create_executable(target, compiler, codeblocks):
@@ -146,14 +176,16 @@ def create_executable(target, compiler, codeblocks):
       build_target.add_option({'object_output': codeblocks.makepath(config.obj)})
       build_target.add_option({'type': '1'})
       build_target.add_option({'compiler': codeblocks.compiler_name})
-      cflags = compiler.get_compiler_flags(target.raw)
-      build_target.add_compiler([codeblocks.cflags, config.cflags, cflags])
-      cleanlib = lambda x: x[2:] if x.startswith('-l') else codeblocks.makepath(config.lib, x)
-      libs = [cleanlib(x) for x in target['dependencies']]
-      lflags = compiler.get_linker_flags(target.raw)
-      build_target.add_linker([codeblocks.lflags, config.lflags, lflags], libs)
+      build_target.add_compiler(get_compiler_options(target, compiler, codeblocks, config))
+      add_linker(build_target, target, compiler, codeblocks, config)
     return project
 
+def add_linker(build_target, target, compiler, codeblocks, config):
+    cleanlib = lambda x: x[2:] if x.startswith('-l') else codeblocks.makepath(config.lib, x)
+    libs = [cleanlib(x) for x in target.get_link_dependencies()]
+    lflags = compiler.get_linker_flags(target.raw)
+    build_target.add_linker([codeblocks.lflags, config.lflags, lflags], libs)
+
 def generate(targets, settings, compiler):
     codeblocks = CodeBlocks(settings, compiler)
     workspace = CodeBlocksWorkspace('all')
@@ -163,13 +195,11 @@ def generate(targets, settings, compiler):
       target_type = target['type']
       if target_type == 'executable':
         project = create_executable(target, compiler, codeblocks)
-      elif target_type == 'static_library':
+      elif target_type in ['static_library', 'shared_library']:
         project = create_library(target, compiler, codeblocks)
       else:
         logging.warning('Target ignored: type "%s" not implemented', target_type)
         continue
       workspace.add_project(project.basename)
-      with open(os.path.join(codeblocks.projectsdir, project.basename), 'w+') as out:
-        out.write(project.tostring())
-    with open(os.path.join(codeblocks.projectsdir, workspace.basename), 'w+') as out:
-      out.write(workspace.tostring())
+      util.write_if_changed(os.path.join(codeblocks.projectsdir, project.basename), project.tostring())
+    util.write_if_changed(os.path.join(codeblocks.projectsdir, workspace.basename), workspace.tostring())
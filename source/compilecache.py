@@ -0,0 +1,328 @@
+# configure.pyz Copyright (C) 2014 N. Subiron Montoro
+#
+# This program comes with ABSOLUTELY NO WARRANTY. This is free software, and you
+# are welcome to redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+
+"""Content-addressed compile cache, used as compiler launcher"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from contextlib import contextmanager
+
+import util
+
+from cache import file_digest
+
+try:
+
+    import fcntl
+
+except ImportError:
+
+    fcntl = None
+
+
+CACHE_VERSION = '1'
+
+SOURCE_EXTENSIONS = ['.c', '.cc', '.cpp', '.cxx', '.c++', '.C']
+
+# Flags dropped when preprocessing, the ones followed by a value drop it too.
+DEPFILE_FLAGS = ['-MD', '-MMD', '-MP']
+DEPFILE_FLAGS_WITH_VALUE = ['-MF', '-MT', '-MQ']
+
+DEPFILE_TARGET = '@@OUT@@'
+
+# Flags writing outputs other than the object, or reading inputs that the
+# preprocessed source does not show. Calls with them are not cached.
+UNCACHEABLE_FLAGS = [
+    '-gsplit-dwarf', '-include-pch', '-save-temps', '-ftest-coverage', '--coverage',
+    '-ftime-trace', '-fdump-', '-fstack-usage', '-fcallgraph-info']
+
+# Flags making the object depend on the working directory.
+CWD_FLAGS = ['-g', '-fprofile-generate', '-fprofile-arcs']
+
+PRECOMPILED_HEADER_EXTENSIONS = ['.gch', '.pch']
+
+
+class Invocation(object):
+    """Compiler command line, split into the parts relevant for caching"""
+
+    def __init__(self, command):
+        self.command = command
+        self.output = None
+        self.depfile = None
+        self.sources = []
+        self.compile_only = False
+        self.uncacheable = None
+        self.profile = None
+        self.uses_cwd = False
+        self.preprocess_command = [command[0]]
+        args = iter(command[1:])
+        for arg in args:
+            if arg == '-c':
+                self.compile_only = True
+            elif arg == '-o':
+                self.output = next(args, None)
+            elif arg in DEPFILE_FLAGS_WITH_VALUE:
+                value = next(args, None)
+                if arg == '-MF':
+                    self.depfile = value
+            elif arg not in DEPFILE_FLAGS:
+                if os.path.splitext(arg)[1] in SOURCE_EXTENSIONS and not arg.startswith('-'):
+                    self.sources.append(arg)
+                elif arg == '-include':
+                    header = next(args, '')
+                    self._check_precompiled_header(header)
+                    self.preprocess_command.append(arg)
+                    arg = header
+                else:
+                    self._check_flag(arg)
+                self.preprocess_command.append(arg)
+        self.preprocess_command.append('-E')
+
+    def _check_flag(self, arg):
+        if any(arg.startswith(x) for x in UNCACHEABLE_FLAGS):
+            self.uncacheable = arg
+        elif arg.startswith('-fprofile-use'):
+            # A merged profile is hashed, gcc's profile folders are not.
+            profile = arg.partition('=')[2]
+            if os.path.isfile(profile):
+                self.profile = profile
+            else:
+                self.uncacheable = arg
+        if any(arg.startswith(x) for x in CWD_FLAGS):
+            self.uses_cwd = True
+
+    def _check_precompiled_header(self, header):
+        if any(os.path.exists(header + x) for x in PRECOMPILED_HEADER_EXTENSIONS):
+            self.uncacheable = '-include ' + header
+
+    def check_preprocessed(self, preprocessed):
+        """The assembler reads .incbin files, the preprocessor does not"""
+        if b'.incbin' in preprocessed:
+            self.uncacheable = '.incbin'
+
+    def is_cacheable(self):
+        return (self.compile_only and self.output is not None and len(self.sources) == 1 and
+                self.uncacheable is None)
+
+
+class CompileCache(object):
+    """Objects and depfiles stored by the hash of the preprocessed source, the
+    compiler and its flags. Least recently used entries are evicted once the
+    store is bigger than max_size."""
+
+    def __init__(self, directory, max_size):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_size = max_size
+        util.mkdir_p(self.directory)
+        self._stats_path = os.path.join(self.directory, 'stats.json')
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.directory, 'lock'), 'a+') as fd:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+
+    def _read_stats(self):
+        stats = {'hits': 0, 'misses': 0, 'uncacheable': 0, 'size': 0, 'evicted': 0}
+        if os.path.isfile(self._stats_path):
+            with open(self._stats_path, 'r') as fd:
+                try:
+                    stats.update(json.load(fd))
+                except ValueError:
+                    pass
+        return stats
+
+    def update_stats(self, **increments):
+        with self._lock():
+            stats = self._read_stats()
+            for key, value in increments.items():
+                stats[key] += value
+            with open(self._stats_path, 'w') as fd:
+                json.dump(stats, fd)
+        if stats['size'] > self.max_size:
+            self.evict()
+
+    def get_stats(self):
+        with self._lock():
+            return self._read_stats()
+
+    def lookup(self, key):
+        path = self._entry_path(key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def store(self, key, files):
+        """Store files, a dictionary name => path, under key. Returns the size
+        added to the store."""
+        path = self._entry_path(key)
+        if os.path.isdir(path):
+            return 0
+        util.mkdir_p(os.path.dirname(path))
+        tempdir = tempfile.mkdtemp(dir=os.path.dirname(path))
+        size = 0
+        for name, filepath in files.items():
+            shutil.copyfile(filepath, os.path.join(tempdir, name))
+            size += os.path.getsize(filepath)
+        try:
+            os.rename(tempdir, path)
+        except OSError:
+            # Stored meanwhile by another process.
+            shutil.rmtree(tempdir, ignore_errors=True)
+            return 0
+        return size
+
+    def evict(self):
+        """Remove least recently used entries until the store is at 90% of its
+        maximum size."""
+        with self._lock():
+            entries = []
+            for prefix in os.listdir(self.directory):
+                prefix_path = os.path.join(self.directory, prefix)
+                if not os.path.isdir(prefix_path):
+                    continue
+                for key in os.listdir(prefix_path):
+                    path = os.path.join(prefix_path, key)
+                    size = sum(os.path.getsize(os.path.join(path, x)) for x in os.listdir(path))
+                    entries.append((os.stat(path).st_mtime, size, path))
+            entries.sort()
+            size = sum(x[1] for x in entries)
+            evicted = 0
+            while entries and size > self.max_size * 0.9:
+                _, entry_size, path = entries.pop(0)
+                shutil.rmtree(path, ignore_errors=True)
+                size -= entry_size
+                evicted += 1
+            stats = self._read_stats()
+            stats['size'] = size
+            stats['evicted'] += evicted
+            with open(self._stats_path, 'w') as fd:
+                json.dump(stats, fd)
+
+
+def _run(command):
+    """Run command forwarding its output, returns the exit code."""
+    try:
+        return subprocess.call(command)
+    except OSError as exception:
+        logging.error('Cannot run %s: %s', command[0], exception)
+        return 127
+
+
+def execute(cache, command):
+    """Run a compiler command through cache, returns the exit code."""
+    invocation = Invocation(command)
+    if not invocation.is_cacheable():
+        if invocation.uncacheable is not None:
+            logging.info('Not cached, %s: %s', invocation.uncacheable, ' '.join(command))
+        cache.update_stats(uncacheable=1)
+        return _run(command)
+    process = subprocess.Popen(
+        invocation.preprocess_command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    preprocessed, _ = process.communicate()
+    if process.returncode == 0:
+        invocation.check_preprocessed(preprocessed)
+    if process.returncode != 0 or invocation.uncacheable is not None:
+        if invocation.uncacheable is not None:
+            logging.info('Not cached, %s: %s', invocation.uncacheable, ' '.join(command))
+        cache.update_stats(uncacheable=1)
+        return _run(command)
+    digest = hashlib.sha256()
+    items = [CACHE_VERSION, util.program_identity(command[0])] + invocation.preprocess_command
+    if invocation.uses_cwd:
+        # Debug info and profiles record absolute paths.
+        items.append(os.getcwd())
+    if invocation.profile is not None:
+        items.append(file_digest(invocation.profile))
+    for item in items:
+        digest.update(item.encode('utf-8') + b'\0')
+    digest.update(preprocessed)
+    key = digest.hexdigest()
+
+    entry = cache.lookup(key)
+    if entry is not None and _restore(entry, invocation):
+        cache.update_stats(hits=1)
+        return 0
+
+    process = subprocess.Popen(command, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    _write_binary(sys.stderr, stderr)
+    if process.returncode != 0 or not os.path.isfile(invocation.output):
+        cache.update_stats(misses=1)
+        return process.returncode
+    tempdir = tempfile.mkdtemp()
+    try:
+        files = {'object': invocation.output, 'stderr': os.path.join(tempdir, 'stderr')}
+        with open(files['stderr'], 'wb') as fd:
+            fd.write(stderr)
+        if invocation.depfile is not None and os.path.isfile(invocation.depfile):
+            with open(invocation.depfile, 'r') as fd:
+                depfile = fd.read()
+            files['depfile'] = os.path.join(tempdir, 'depfile')
+            with open(files['depfile'], 'w') as fd:
+                fd.write(depfile.replace(invocation.output, DEPFILE_TARGET, 1))
+        size = cache.store(key, files)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+    cache.update_stats(misses=1, size=size)
+    return 0
+
+
+def _restore(entry, invocation):
+    """Copy the outputs stored in entry, False if it was evicted meanwhile"""
+    try:
+        util.mkdir_p(os.path.dirname(invocation.output) or '.')
+        shutil.copyfile(os.path.join(entry, 'object'), invocation.output)
+        if invocation.depfile is not None and os.path.isfile(os.path.join(entry, 'depfile')):
+            with open(os.path.join(entry, 'depfile'), 'r') as fd:
+                depfile = fd.read().replace(DEPFILE_TARGET, invocation.output, 1)
+            with open(invocation.depfile, 'w') as fd:
+                fd.write(depfile)
+        with open(os.path.join(entry, 'stderr'), 'rb') as fd:
+            stderr = fd.read()
+    except (IOError, OSError) as exception:
+        logging.info('Compile cache entry lost, compiling: %s', exception)
+        return False
+    _write_binary(sys.stderr, stderr)
+    return True
+
+
+def _write_binary(stream, data):
+    if data:
+        stream.flush()
+        getattr(stream, 'buffer', stream).write(data)
+        stream.flush()
+
+
+def print_stats(cache):
+    stats = cache.get_stats()
+    lookups = stats['hits'] + stats['misses']
+    ratio = 100.0 * stats['hits'] / lookups if lookups else 0.0
+    util.print_out('compile cache %s' % cache.directory)
+    util.print_out('  hits         %i (%.1f%%)' % (stats['hits'], ratio))
+    util.print_out('  misses       %i' % stats['misses'])
+    util.print_out('  uncacheable  %i' % stats['uncacheable'])
+    util.print_out('  evicted      %i' % stats['evicted'])
+    util.print_out('  size         %.1f of %.1f MB' % (
+        stats['size'] / 1048576.0, cache.max_size / 1048576.0))
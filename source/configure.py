@@ -12,6 +12,7 @@
 import __builtin__
 
 import argparse
+import atexit
 import glob
 import json
 import logging
@@ -19,28 +20,100 @@ import os
 import re
 import sys
 
+import tracing
 import util
+from cache import DocumentCache
+from cache import ScanCache
 from util import STRING_TYPES
 from util import critical_error
 from util import print_out
 
 
+DEFAULT_COMPILE_CACHE = {'dir': '~/.cache/configure.pyz', 'max_size': '5G'}
+
+DEFAULT_LTO_CACHE = {'dir': '$builddir/lto_cache', 'max_size': '2G'}
+
+PGO_INSTRUMENTED_SUFFIX = '_instrumented'
+
+DOCUMENT_CACHE_FILENAME = '.configure.pyz.cache'
+
+# Embedded data of each folder, at the same path under EMBEDDED_DATA_DIR.
+EMBEDDED_DATA_DIR = '$builddir/embedded_data'
+
+EMBEDDED_DATA_FILES = ['embedded_data.cpp', 'embedded_data.h']
+
+
+def get_program():
+    """Path to this program relative to the working directory"""
+    return Path.clean(os.path.relpath(sys.argv[0]))
+
+
+class VariableExpander(object):
+    """Expand variables in strings.
+
+    "${name}" expands to the value of name, "$name" to the value of the longest
+    variable name found right after the "$". Unknown variables are left as they
+    are (e.g., ninja's "$out"). Values may reference other variables, these are
+    resolved once on construction so expanding a string is a single pass."""
+
+    MEMO_MAX_LENGTH = 1024
+
+    def __init__(self, variables):
+        names = sorted(variables, key=lambda x: (-len(x), x))
+        alternation = '|'.join(re.escape(x) for x in names) or '(?!)'
+        self._regex = re.compile(r'\$(?:\{(%s)\}|(%s))' % (alternation, alternation))
+        self._memo = {}
+        self._values = {}
+        raw = dict((k, v if isinstance(v, STRING_TYPES) else str(v)) for k, v in variables.items())
+        for name in names:
+            self._resolve(name, raw, [])
+
+    def _resolve(self, name, raw, stack):
+        if name not in self._values:
+            if name in stack:
+                critical_error('Variable "%s" references itself', name)
+            stack.append(name)
+            replace = lambda match: self._resolve(match.group(1) or match.group(2), raw, stack)
+            self._values[name] = self._regex.sub(replace, raw[name])
+            stack.pop()
+        return self._values[name]
+
+    def _replace(self, match):
+        return self._values[match.group(1) or match.group(2)]
+
+    def expand(self, string):
+        if '$' not in string:
+            return string
+        if string in self._memo:
+            return self._memo[string]
+        result = self._regex.sub(self._replace, string)
+        if len(string) <= self.MEMO_MAX_LENGTH:
+            self._memo[string] = result
+        return result
+
+
 class Settings(object):
     __DATA = None
-    __VARIABLES_EXTENDED = None
+    __EXPANDER = None
 
     @staticmethod
     def load(filepath):
-        Settings.__DATA = {'variables': {}}
-        Settings.__DATA.update(util.load_yaml(filepath))
-        Settings.__VARIABLES_EXTENDED = dict(Settings.__DATA['variables'])
+        with tracing.span('Settings.load', file=filepath):
+            Settings.__DATA = {'variables': {}}
+            Settings.__DATA.update(util.load_yaml(filepath))
+        variables = dict(Settings.__DATA['variables'])
         root = os.path.abspath('.').replace('\\', '/')
-        Settings.__VARIABLES_EXTENDED.update({
+        variables.update({
             'rootpath': root,
             'rootdir': root,
             'cflags': Settings.get('compiler').get('cflags', ''),
             'lflags': Settings.get('compiler').get('lflags', '')
         })
+        Settings.__EXPANDER = VariableExpander(variables)
+
+    @staticmethod
+    def is_loaded():
+        return Settings.__DATA is not None
 
     @staticmethod
     def get(key):
@@ -53,9 +126,7 @@ class Settings(object):
     @staticmethod
     def expand_variables(obj):
         if isinstance(obj, STRING_TYPES):
-            for key, value in Settings.__VARIABLES_EXTENDED.items():
-                obj = re.sub(r'(\$\{?%s\}?)' % key, value, obj)
-            return obj
+            return Settings.__EXPANDER.expand(obj)
         elif isinstance(obj, list):
             return [Settings.expand_variables(x) for x in obj]
         elif isinstance(obj, dict):
@@ -84,61 +155,271 @@ class Path(object):
             return Settings.get('root_target_name')
         return Path.clean(path).replace('/', '_')
 
-    @staticmethod
-    def expand_patterns(patterns, prefix):
+
+
+class FileIndex(object):
+    """Files of a folder, listed once and shared by all its targets.
+
+    Patterns are matched as glob does: wildcards match neither "/" nor a
+    leading "." unless the pattern starts with one. Results of each pattern
+    are sorted and cached."""
+
+    def __init__(self, directory, path, files):
+        self.directory = directory
+        self.path = path
+        self.files = files
+        self._listings = {'': (None, set(files))}
+        self._matches = {}
+        self._joined_files = None
+
+    def joined_files(self):
+        """Files of the folder with the folder path as prefix"""
+        if self._joined_files is None:
+            self._joined_files = [Path.join(self.path, x) for x in self.files]
+        return self._joined_files
+
+    def expand(self, patterns):
+        """Files matching patterns, prefixed with the folder path and without
+        duplicates"""
         files = []
+        seen = set()
         for pattern in patterns:
-            files.extend(glob.glob(pattern))
-        return [Path.join(prefix, x) for x in files if os.path.isfile(x)]
+            for filepath in self._match(pattern):
+                if filepath not in seen:
+                    seen.add(filepath)
+                    files.append(filepath)
+        return files
+
+    def _match(self, pattern):
+        if pattern not in self._matches:
+            if os.path.isabs(pattern):
+                files = [x for x in glob.glob(pattern) if os.path.isfile(x)]
+                files = [os.path.relpath(x, self.directory) for x in files]
+            else:
+                files = self._match_relative([x for x in pattern.split('/') if x not in ['', '.']])
+            self._matches[pattern] = [Path.join(self.path, x) for x in sorted(files)]
+        return self._matches[pattern]
+
+    def _match_relative(self, parts):
+        candidates = ['']
+        for index, part in enumerate(parts):
+            is_last = index == len(parts) - 1
+            matches = []
+            for base in candidates:
+                dirs, files = self._listdir(base, need_dirs=not is_last)
+                names = files if is_last else dirs
+                if not glob.has_magic(part):
+                    if part in names or (part == '..' and not is_last):
+                        matches.append(os.path.join(base, part))
+                    continue
+                regex = util.glob_regex(part)
+                hidden = part.startswith('.')
+                matches.extend(os.path.join(base, x) for x in sorted(names)
+                               if regex.match(x) and (hidden or not x.startswith('.')))
+            candidates = matches
+        return candidates
+
+    def _listdir(self, base, need_dirs):
+        dirs, files = self._listings.get(base, (None, None))
+        if files is None or (need_dirs and dirs is None):
+            try:
+                dirs, files = util.listdir(os.path.join(self.directory, base))
+            except OSError:
+                dirs, files = [], []
+            dirs, files = set(dirs), set(files)
+            self._listings[base] = dirs, files
+        return dirs, files
 
 
 class Target(object):
     """Build target from source directory tree"""
 
-    def __init__(self, path, files, data=None):
-        self.path = path
+    def __init__(self, index, data=None):
+        self.path = index.path
+        self.subdirs = set()
+        self.link_dependencies = None
         self.raw = dict(Settings.get('targets')['defaults'])
-        self.raw['target_name'] = Path.target_name(path)
+        self.raw['target_name'] = Path.target_name(self.path)
         if data is not None:
             self.raw.update(data)
-        self._expand(files)
-        if self.raw['type'] != 'executable':
+        with tracing.span('Target._expand', target=self.raw['target_name']):
+            self._expand(index)
+        if self.raw['type'] == 'shared_library':
+            self.raw['target_name'] += '.so'
+        elif self.raw['type'] != 'executable':
             self.raw['target_name'] += '.a'
 
+    @staticmethod
+    def from_raw(path, raw):
+        """Rebuild an already expanded target"""
+        target = Target.__new__(Target)
+        target.path = path
+        target.subdirs = None
+        target.link_dependencies = None
+        target.raw = raw
+        return target
+
     def __getitem__(self, key):
         return self.raw[key]
 
-    def _expand(self, files):
+    def get(self, key, default=None):
+        return self.raw.get(key, default)
+
+    def get_link_dependencies(self):
+        """Dependencies in link order, transitive ones included once the
+        target graph is resolved"""
+        if self.link_dependencies is None:
+            return self.raw['dependencies']
+        return self.link_dependencies
+
+    def _expand(self, index):
+        used = set()
         for key in ['sources', 'headers', 'embedded_data']:
-            self.raw[key] = Path.expand_patterns(self.raw[key], self.path)
-        used = lambda x: x in self.raw['sources'] or x in self.raw['headers'] or x in self.raw['embedded_data']
-        files = [Path.join(self.path, x) for x in files]
-        self.raw['unused'] = [x for x in files if not used(x)]
+            self._add_subdirs(self.raw[key])
+            self.raw[key] = index.expand(self.raw[key])
+            used.update(self.raw[key])
+        if self.raw.get('unity_exclude'):
+            self._add_subdirs(self.raw['unity_exclude'])
+            self.raw['unity_exclude'] = index.expand(self.raw['unity_exclude'])
+        if self.raw.get('precompiled_header'):
+            self._expand_precompiled_header(index)
+            used.add(self.raw['precompiled_header'])
+        self.raw['unused'] = [x for x in index.joined_files() if x not in used]
+
+    def _expand_precompiled_header(self, index):
+        pattern = self.raw['precompiled_header']
+        self._add_subdirs([pattern])
+        matches = index.expand([pattern])
+        if len(matches) != 1:
+            critical_error(
+                'Precompiled header "%s" of target "%s" must match a single file',
+                pattern, self.raw['target_name'])
+        self.raw['precompiled_header'] = matches[0]
+
+    def _add_subdirs(self, patterns):
+        """Keep track of the subfolders the patterns look into, None if they
+        cannot be known beforehand."""
+        for pattern in patterns:
+            subdir = os.path.dirname(pattern)
+            if self.subdirs is None or not subdir:
+                continue
+            if glob.has_magic(subdir) or os.path.isabs(subdir) or '..' in subdir.split('/'):
+                self.subdirs = None
+            else:
+                self.subdirs.add(subdir)
+
+
+class TargetGraph(object):
+    """Dependencies between targets. Resolves the libraries each target links
+    transitively, in link order: every library before the ones it depends on,
+    and linker flags (-l) at the end. Shared libraries are linked with their
+    own dependencies, so these are not followed through them."""
+
+    def __init__(self, targets):
+        self._targets = {}
+        for target in targets:
+            name = target['target_name']
+            if name in self._targets:
+                critical_error('Duplicated target "%s" in $sourcedir/%s', name, target.path)
+            self._targets[name] = target
+        for target in targets:
+            for item in target['dependencies']:
+                if item.startswith('-l'):
+                    continue
+                if item not in self._targets:
+                    critical_error('Target "%s" depends on unknown target "%s"',
+                                   target['target_name'], item)
+                if self._targets[item]['type'] == 'executable':
+                    critical_error('Target "%s" depends on executable "%s"',
+                                   target['target_name'], item)
+        linked = set()
+        for target in targets:
+            target.link_dependencies = self._resolve(target)
+            if target['type'] == 'executable':
+                linked.update(target.link_dependencies)
+        unreachable = sorted(x for x, y in self._targets.items()
+                             if y['type'] != 'executable' and x not in linked)
+        if unreachable:
+            logging.info('Libraries not linked by any executable: %s', ', '.join(unreachable))
+
+    def _resolve(self, target):
+        order = []
+        flags = []
+        state = {}
+        # Dependencies are visited backwards to keep their order when equal.
+        stack = [(target['target_name'], reversed(target['dependencies']))]
+        state[target['target_name']] = False
+        while stack:
+            name, dependencies = stack[-1]
+            item = next(dependencies, None)
+            if item is None:
+                stack.pop()
+                state[name] = True
+                order.append(name)
+            elif item.startswith('-l'):
+                if item not in flags:
+                    flags.append(item)
+            elif item not in state:
+                state[item] = False
+                dependency = self._targets[item]
+                following = [] if dependency['type'] == 'shared_library' else dependency['dependencies']
+                stack.append((item, reversed(following)))
+            elif not state[item]:
+                cycle = [x[0] for x in stack] + [item]
+                critical_error('Dependency cycle: %s', ' -> '.join(cycle[cycle.index(item):]))
+        order.pop()
+        return list(reversed(order)) + list(reversed(flags))
 
 
 class Configuration(object):
     """Compiler configuration in settings file"""
 
+    @staticmethod
+    def getdir(data, key):
+        """Folder key (bin, lib or obj) of the configuration data"""
+        return data.get(key, '$builddir/%s_%s' % (key, data['name']))
+
     def __init__(self, data):
         if 'name' not in data:
             critical_error('Missing name of configuration in settings file')
         self.name = data['name']
         self.cflags = Compiler.get_compiler_flags(data)
         self.lflags = Compiler.get_linker_flags(data)
-        getdir = lambda key: data.get(key, '$buildir/%s_%s' % (key, self.name))
-        self.bin = getdir('bin')
-        self.lib = getdir('lib')
-        self.obj = getdir('obj')
+        self.bin = self.getdir(data, 'bin')
+        self.lib = self.getdir(data, 'lib')
+        self.obj = self.getdir(data, 'obj')
+        self.pools = data.get('pools', {})
+        self.unity = data.get('unity', None)
+        self.launcher = ''
+        self.split_dwarf = False
+        self.archiver = None
+        self.profile = None
+        self.training = None
 
 
 class Compiler(object):
     """Compiler settings in settings files"""
 
     def __init__(self, settings):
-        raw = settings.get('configurations')
+        raw = []
+        for data in settings.get('configurations'):
+            raw.append(data)
+            if data.get('pgo', None):
+                raw.append(Compiler.get_instrumented_data(data))
         self._configurations = [Configuration(x) for x in raw]
         cdata = settings.get('compiler')
-        self._variables = {'cxx': cdata['cxx']}
+        self._family = 'clang' if 'clang' in os.path.basename(cdata['cxx']) else 'gcc'
+        for data, config in zip(raw, self._configurations):
+            launcher = data.get('launcher', cdata.get('launcher', None))
+            config.launcher = Compiler.get_launcher(launcher, cdata, settings)
+            Compiler.add_debug_options(config, data, cdata['cxx'])
+            if data.get('lto', None):
+                self.add_lto_options(config, data, cdata, settings)
+        for index, data in enumerate(raw):
+            if data.get('pgo', None):
+                optimized, instrumented = self._configurations[index:index + 2]
+                self.add_pgo_options(optimized, instrumented, data['pgo'], cdata, settings)
+        self._variables = {'cxx': cdata['cxx'], 'ar': cdata.get('ar', 'ar')}
         self._variables['cflags'] = Compiler.get_compiler_flags(cdata)
         self._variables['lflags'] = Compiler.get_linker_flags(cdata)
 
@@ -148,6 +429,10 @@ class Compiler(object):
     def get_global_variables(self):
         return self._variables
 
+    def get_family(self):
+        """Either "clang" or "gcc", the flavour of flags the compiler takes"""
+        return self._family
+
     @staticmethod
     def get_compiler_flags(data):
         cflags = data.get('cflags', '').split()
@@ -159,6 +444,83 @@ class Compiler(object):
     def get_linker_flags(data):
         return ' '.join(data.get('lflags', '').split())
 
+    @staticmethod
+    def add_debug_options(config, data, cxx):
+        """Linker and debug info flags of a configuration, probed beforehand.
+        The ones the compiler does not support are left out."""
+        import toolchain
+        options = toolchain.DebugOptions(cxx, config.name, data)
+        config.cflags = ' '.join([config.cflags] + options.cflags).strip()
+        config.lflags = ' '.join([config.lflags] + options.lflags).strip()
+        config.split_dwarf = options.split_dwarf
+
+    def add_lto_options(self, config, data, cdata, settings):
+        """Link time optimization flags and archiver of a configuration. The
+        LTO jobs of each link share the CPUs with the other links the link
+        pool allows."""
+        import ninja
+        import toolchain
+        pools, config_pools = ninja.get_pools(settings.get('ninja'), [config])
+        link_pool = config_pools[config.name].get('link')
+        jobs = max(1, util.cpu_count() // pools.get(link_pool, util.cpu_count()))
+        cache = dict(DEFAULT_LTO_CACHE)
+        cache.update(cdata.get('lto_cache', None) or {})
+        cache.update(data.get('lto_cache', None) or {})
+        options = toolchain.LtoOptions(
+            cdata['cxx'], self._family, config.name, data['lto'], jobs,
+            settings.expand_variables(cache['dir']), util.parse_size(cache['max_size']),
+            config.lflags.split())
+        config.cflags = ' '.join([config.cflags] + options.cflags).strip()
+        config.lflags = ' '.join([config.lflags] + options.lflags).strip()
+        config.archiver = options.archiver
+
+    @staticmethod
+    def get_instrumented_data(data):
+        """Settings of the instrumented build of a PGO configuration, the
+        same but for its name and folders."""
+        instrumented = dict(data, name=data['name'] + PGO_INSTRUMENTED_SUFFIX, pgo=None)
+        for key in ['bin', 'lib', 'obj']:
+            instrumented[key] = Configuration.getdir(data, key) + PGO_INSTRUMENTED_SUFFIX
+        return instrumented
+
+    def add_pgo_options(self, optimized, instrumented, pgo, cdata, settings):
+        """Profile the instrumented configuration running the training
+        command, then optimize with the profile. The training command may
+        use $bin, the binaries folder of the instrumented configuration."""
+        import toolchain
+        from ninja import ProfileTraining
+        if not isinstance(pgo, dict) or not pgo.get('training'):
+            critical_error('Missing training command of configuration "%s"', optimized.name)
+        profile_dir = pgo.get('profile_dir', '$builddir/pgo_' + optimized.name)
+        options = toolchain.PgoOptions(
+            cdata['cxx'], self._family, optimized.name, settings.expand_variables(profile_dir),
+            settings.expand_variables(instrumented.obj), settings.expand_variables(optimized.obj))
+        if not options.supported:
+            return
+        instrumented.cflags = ' '.join([instrumented.cflags] + options.generate_cflags)
+        instrumented.lflags = ' '.join([instrumented.lflags] + options.generate_lflags)
+        instrumented.training = ProfileTraining(
+            pgo['training'], options.profile_dir, options.merge_command, options.profile)
+        optimized.cflags = ' '.join([optimized.cflags] + options.use_cflags)
+        optimized.profile = options.profile
+
+    @staticmethod
+    def get_launcher(launcher, cdata, settings):
+        """Command prefixed to compiler calls. "builtin" is configure.pyz's
+        own compile cache, anything else is used as it is (e.g. ccache)."""
+        if not launcher:
+            return ''
+        if launcher != 'builtin':
+            return launcher
+        cache = dict(DEFAULT_COMPILE_CACHE)
+        cache.update(cdata.get('compile_cache', None) or {})
+        return ' '.join([
+            'python', get_program(),
+            '--cache-dir', settings.expand_variables(cache['dir']),
+            '--cache-size', str(cache['max_size']),
+            '--cache-exec'])
+
+
 class HelpGatherer(object):
     def __init__(self, argparser):
         self.command_help = {}
@@ -171,24 +533,143 @@ class HelpGatherer(object):
         self.callback(*args, **kwargs)
 
 
-def iterate_targets(root):
-    """Iterate over the targets generated based on root directory tree"""
+class ScanError(Exception):
+    pass
+
+
+def init_scan_worker(settings_file):
+    if not Settings.is_loaded():
+        Settings.load(settings_file)
+
+
+def scan_folder(args):
+    """Targets of a single folder, run by the scan workers"""
+    root, dirpath, files, target_rules_filepath = args
+    relpath = Path.clean(dirpath)
+    try:
+        with tracing.span('scan_folder', path=relpath):
+            # Left in source folders by former versions, never sources.
+            for filename in [x for x in EMBEDDED_DATA_FILES if x in files]:
+                logging.warning('Ignoring $sourcedir/%s, embedded data is generated in %s',
+                                Path.join(relpath, filename), EMBEDDED_DATA_DIR)
+            files = [x for x in files if x not in EMBEDDED_DATA_FILES]
+            index = FileIndex(os.path.join(root, dirpath), relpath, files)
+            if target_rules_filepath is None:
+                return [Target(index)]
+            target_rules = util.load_yaml_or_json(target_rules_filepath)
+            return [Target(index, x) for x in target_rules.get('targets', [])]
+    except SystemExit:
+        # The error is already logged, sys.exit would hang the pool.
+        raise ScanError('Error scanning $sourcedir/%s' % relpath)
+
+
+def iterate_targets(root, cache, create_pool=lambda: None):
+    """Iterate over the targets generated based on root directory tree.
+
+    Folders missing in the cache are scanned in the pool returned by
+    create_pool, targets are yielded in the order of the walk regardless."""
     root = os.path.abspath(root)
     logging.info('sourcedir=%s', root)
     target_rules_filename = Settings.get('targets')['filename']
-    for path, files in util.walk(root):
-        with util.pushd(os.path.join(root, path)):
-            relpath = Path.clean(path.replace(root, ''))
-            logging.info('Parsing folder: $sourcedir/%s', relpath)
-            if not files:
-                logging.debug('No files found')
-            elif target_rules_filename in files:
-                target_rules_filepath = os.path.join(path, target_rules_filename)
-                target_rules = util.load_yaml_or_json(target_rules_filepath)
-                for gyp_target in target_rules.get('targets', []):
-                    yield Target(relpath, files, gyp_target)
-            else:
-                yield Target(relpath, files)
+    folders = []
+    for dirpath, files in cache.walk(root):
+        logging.info('Parsing folder: $sourcedir/%s', Path.clean(dirpath))
+        tracing.count('folders')
+        tracing.count('files', len(files))
+        if not files:
+            logging.debug('No files found')
+            continue
+        target_rules_filepath = None
+        if target_rules_filename in files:
+            target_rules_filepath = os.path.join(root, dirpath, target_rules_filename)
+        cached = cache.get_targets(root, dirpath, target_rules_filepath)
+        folders.append((dirpath, files, target_rules_filepath, cached))
+    pending = [(root, x[0], x[1], x[2]) for x in folders if x[3] is None]
+    logging.info('Scanning %i folders', len(pending))
+    tracing.count('folders scanned', len(pending))
+    pool = create_pool() if len(pending) > 1 else None
+    try:
+        scanned = iter(util.pool_map(pool, scan_folder, pending))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for dirpath, files, target_rules_filepath, cached in folders:
+        if cached is not None:
+            for raw in cached:
+                yield Target.from_raw(Path.clean(dirpath), raw)
+            continue
+        targets = next(scanned)
+        cache.set_targets(root, dirpath, target_rules_filepath, targets)
+        for target in targets:
+            yield target
+
+
+def get_folder_targets(root, dirpath):
+    """Targets of a single folder of root, without walking the rest"""
+    path = os.path.join(root, dirpath)
+    if not os.path.isdir(path):
+        critical_error('Folder not found: %s', path)
+    _, files = util.listdir(path)
+    target_rules_filename = Settings.get('targets')['filename']
+    target_rules_filepath = None
+    if target_rules_filename in files:
+        target_rules_filepath = os.path.join(path, target_rules_filename)
+    try:
+        return scan_folder((os.path.abspath(root), dirpath, files, target_rules_filepath))
+    except ScanError as exception:
+        critical_error(exception)
+
+
+def get_scan_cache(disabled):
+    """Scan cache stored in builddir, invalidated by changes to the targets
+    settings"""
+    filepath = None if disabled else Settings.expand_variables('$builddir/scan_cache.json')
+    key = json.dumps([
+        util.get_version(),
+        Settings.get('sourcedir'),
+        Settings.get('variables').get('root_target_name'),
+        Settings.get('targets')], sort_keys=True)
+    return ScanCache(filepath, key)
+
+
+def get_document_cache(settings_file, disabled):
+    """Document cache stored next to the settings file, as builddir is not
+    known until these are parsed"""
+    filepath = None
+    if not disabled:
+        filepath = os.path.join(os.path.dirname(settings_file), DOCUMENT_CACHE_FILENAME)
+    program = sys.argv[0]
+    stat = os.stat(program) if os.path.isfile(program) else None
+    key = json.dumps([
+        util.get_version(),
+        sys.version,
+        os.path.abspath(program),
+        None if stat is None else [stat.st_mtime, stat.st_size]])
+    return DocumentCache(filepath, key)
+
+
+def get_regeneration(args, command_call, cache):
+    """How ninja re-runs this very command when settings or sources change,
+    with the same generators and options"""
+    from ninja import Regeneration
+    outputs = [Settings.get('ninja').get('filename', 'build.ninja')]
+    generators = ['--ninja']
+    makefile = Settings.get('makefile').get('filename', 'Makefile')
+    if args.makefile or os.path.isfile(makefile):
+        outputs.append(makefile)
+        generators.append('--makefile')
+    generators += ['--' + x for x in ['doxyfile', 'sublime', 'codeblocks'] if getattr(args, x)]
+    if args.jobs != util.cpu_count():
+        generators += ['-j', str(args.jobs)]
+    if args.scan_processes:
+        generators.append('--scan-processes')
+    if args.no_cache:
+        generators.append('--no-cache')
+    command = ' '.join(['python'] + command_call + generators)
+    inputs = [args.settings_file, command_call[0]]
+    inputs += [Path.join('$sourcedir', x) for x in cache.get_inputs()]
+    return Regeneration(command, inputs, outputs)
 
 
 def main():
@@ -205,6 +686,44 @@ def main():
         '--targets',
         action='store_true',
         help='write out targets (for debugging purposes)')
+    argparser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='scan the whole source tree, parse every file and embed every resource, ignoring the caches')
+    argparser.add_argument(
+        '-j', '--jobs',
+        metavar='N',
+        type=int,
+        default=util.cpu_count(),
+        help='number of parallel jobs scanning the source tree or embedding, defaults to the number of CPUs')
+    argparser.add_argument(
+        '--trace',
+        metavar='FILE',
+        help='write a Chrome trace (chrome://tracing) of the run to FILE, --debug prints a summary')
+    argparser.add_argument(
+        '--scan-processes',
+        action='store_true',
+        help='scan the source tree with a pool of processes instead of threads')
+    cache_group = argparser.add_argument_group('compile cache')
+    cache_group.add_argument(
+        '--cache-exec',
+        nargs=argparse.REMAINDER,
+        metavar='COMMAND',
+        help='run a compiler command through the compile cache, must be the last option')
+    cache_group.add_argument(
+        '--cache-stats',
+        action='store_true',
+        help='print statistics of the compile cache')
+    cache_group.add_argument(
+        '--cache-dir',
+        metavar='DIR',
+        default=DEFAULT_COMPILE_CACHE['dir'],
+        help='compile cache directory, defaults to %s' % DEFAULT_COMPILE_CACHE['dir'])
+    cache_group.add_argument(
+        '--cache-size',
+        metavar='SIZE',
+        default=DEFAULT_COMPILE_CACHE['max_size'],
+        help='maximum size of the compile cache, defaults to %s' % DEFAULT_COMPILE_CACHE['max_size'])
     argparser.add_argument(
         '--hello-world',
         action='store_true',
@@ -229,6 +748,10 @@ def main():
         '--embed',
         action='store_true',
         help='embed resources (experimental)')
+    argparser.add_argument(
+        '--embed-dir',
+        metavar='DIR',
+        help='embed the resources of the targets in DIR, relative to sourcedir, as ninja does')
     generators_group.add_argument(
         '--ninja',
         action='store_true',
@@ -254,6 +777,16 @@ def main():
     loglevel = logging.DEBUG if args.debug else logging.WARNING
     logging.basicConfig(format='%(levelname)s: %(message)s', level=loglevel)
 
+    if args.cache_exec is not None or args.cache_stats:
+        import compilecache
+        cache = compilecache.CompileCache(args.cache_dir, util.parse_size(args.cache_size))
+        if args.cache_stats:
+            compilecache.print_stats(cache)
+        if args.cache_exec:
+            command = args.cache_exec[1:] if args.cache_exec[0] == '--' else args.cache_exec
+            sys.exit(compilecache.execute(cache, command))
+        return
+
     try:
       builtin_open = __builtin__.open
       def open_hook(*args, **kwargs):
@@ -280,6 +813,24 @@ def main():
         argparser.print_usage()
         return
 
+    if args.trace is not None or args.debug:
+        tracing.enable()
+        atexit.register(tracing.finish, args.trace)
+
+    documents = get_document_cache(args.settings_file, args.no_cache)
+    util.set_document_cache(documents)
+    atexit.register(documents.save)
+
+    if args.embed_dir is not None:
+        Settings.load(args.settings_file)
+        import embedder
+        sourcedir = Settings.get('sourcedir')
+        targets = get_folder_targets(sourcedir, args.embed_dir)
+        with tracing.span('embedder', path=args.embed_dir):
+            embedder.embed(
+                targets, sourcedir, Settings.expand_variables(EMBEDDED_DATA_DIR), report=False)
+        return
+
     actions = ['targets', 'embed', 'ninja', 'makefile', 'doxyfile', 'sublime', 'codeblocks']
     action_count = sum(getattr(args, x) for x in actions)
 
@@ -290,15 +841,24 @@ def main():
 
     Settings.load(args.settings_file)
 
-    targets = [x for x in iterate_targets(Settings.get('sourcedir'))]
+    cache = get_scan_cache(args.no_cache)
+    create_pool = lambda: util.create_pool(
+        args.jobs, args.scan_processes, init_scan_worker, (args.settings_file,))
+    try:
+        with tracing.span('iterate_targets'):
+            targets = [x for x in iterate_targets(Settings.get('sourcedir'), cache, create_pool)]
+    except ScanError as exception:
+        critical_error(exception)
+    cache.save()
     logging.info('%i targets found', len(targets))
+    tracing.count('targets', len(targets))
+    with tracing.span('TargetGraph'):
+        TargetGraph(targets)
 
     if args.targets:
         data = {'targets': [x.raw for x in targets]}
         targets_file = os.path.join(Settings.get('builddir'), 'targets.json')
-        util.mkdir_p(os.path.dirname(targets_file))
-        with open(targets_file, 'w+') as out:
-            out.write(json.dumps(data, indent=2))
+        util.write_if_changed(targets_file, json.dumps(data, indent=2, sort_keys=True))
         print_out('Targets saved to %s.' % targets_file)
         if action_count == 1:
             return
@@ -306,38 +866,53 @@ def main():
     if args.embed:
         print_out(help_gatherer.command_help['--embed'])
         import embedder
-        embedder.embed(targets, Settings.get('sourcedir'))
-        print_out("Targets may have changed, re-run configure.pyz to update.")
+        manifest = None
+        if not args.no_cache:
+            manifest = os.path.join(Settings.get('builddir'), 'embed_manifest.json')
+        with tracing.span('embedder'):
+            embedder.embed(
+                targets, Settings.get('sourcedir'), Settings.expand_variables(EMBEDDED_DATA_DIR),
+                args.jobs, manifest)
         return
 
-    compiler = Compiler(Settings)
+    with tracing.span('Compiler'):
+        compiler = Compiler(Settings)
 
     if args.doxyfile:
         print_out(help_gatherer.command_help['--doxyfile'])
         import doxygen
-        doxygen.generate(Settings)
+        with tracing.span('doxygen'):
+            doxygen.generate(Settings)
 
     if args.ninja or args.makefile or args.sublime:
         print_out(help_gatherer.command_help['--ninja'])
         import ninja
-        ninja_targets = ninja.generate(targets, Settings, compiler, '.')
+        command_call = [get_program(), '-f', args.settings_file]
+        regeneration = get_regeneration(args, command_call, cache)
+        embedding = ninja.Embedding(
+            ' '.join(['python'] + command_call + ['--embed-dir']),
+            [args.settings_file, command_call[0]])
+        with tracing.span('ninja'):
+            ninja_targets = ninja.generate(
+                targets, Settings, compiler, '.', regeneration, embedding)
 
         if args.makefile:
             print_out(help_gatherer.command_help['--makefile'])
             import makefile
-            this = Path.clean(os.path.relpath(sys.argv[0]))
-            command_call = [this, '-f', args.settings_file]
-            makefile.generate(command_call, ninja_targets, actions, Settings, '.')
+            with tracing.span('makefile'):
+                makefile.generate(command_call, ninja_targets, actions, Settings, '.')
 
         if args.sublime:
             print_out(help_gatherer.command_help['--sublime'])
             import sublime
-            sublime.generate(ninja_targets, Settings)
+            with tracing.span('sublime'):
+                sublime.generate(ninja_targets, Settings)
 
     if args.codeblocks:
         print_out(help_gatherer.command_help['--codeblocks'])
         import codeblocks
-        codeblocks.generate(targets, Settings, compiler)
+        with tracing.span('codeblocks'):
+            codeblocks.generate(targets, Settings, compiler)
 
 
 if __name__ == '__main__':
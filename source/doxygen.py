@@ -23,5 +23,4 @@ def generate(settings):
         template = util.get_resource('defaults/Doxyfile')
     doxyfile = settings.expand_variables(template)
 
-    with open(settings.expand_variables('$builddir/Doxyfile'), 'w+') as fd:
-        fd.write(doxyfile)
+    util.write_if_changed(settings.expand_variables('$builddir/Doxyfile'), doxyfile)
@@ -7,32 +7,216 @@
 
 """Embed files into C code"""
 
-import binascii
 import filecmp
+import glob
+import hashlib
+import json
+import logging
 import os
 import shutil
 import tempfile
-import textwrap
+import time
+import zlib
 
-def _embed(inputfile, chunksize=2, width=80, indent=2):
+from collections import OrderedDict
+from collections import namedtuple
+
+import util
+
+from util import critical_error
+from util import print_out
+
+ENCODINGS = ['array', 'incbin', 'string', 'zlib']
+
+MANIFEST_VERSION = 1
+
+EmbedResult = namedtuple('EmbedResult', 'path, size, seconds')
+
+READ_SIZE = 1024 * 1024
+
+BYTE_LITERALS = ['0x%02x' % x for x in range(256)]
+
+# Printable characters as they are, the rest as octal escapes. Octal escapes
+# end after three digits, unlike hexadecimal ones. "?" is escaped to avoid
+# trigraphs.
+STRING_LITERALS = [
+    chr(x) if 0x20 <= x < 0x7f and chr(x) not in '"\\?' else '\\%03o' % x
+    for x in range(256)]
+
+STRING_LINE_BYTES = 64
+
+# Symbols and sections of the .incbin backend for ELF and Mach-O assemblers.
+INCBIN_PREAMBLE = """#if defined(__APPLE__)
+#  define EMBEDDED_DATA_BEGIN ".const_data\\n"
+#  define EMBEDDED_DATA_END ".text\\n"
+#  define EMBEDDED_DATA_SYMBOL(name) "_" #name
+#else
+#  define EMBEDDED_DATA_BEGIN ".pushsection .rodata\\n"
+#  define EMBEDDED_DATA_END ".popsection\\n"
+#  define EMBEDDED_DATA_SYMBOL(name) #name
+#endif
+
+"""
+
+INCBIN_FORMAT = """__asm__(
+    "# %(sha1)s %(filepath)s\\n"
+    EMBEDDED_DATA_BEGIN
+    ".globl " EMBEDDED_DATA_SYMBOL(%(name)s) "\\n"
+    ".balign 16\\n"
+    EMBEDDED_DATA_SYMBOL(%(name)s) ":\\n"
+    ".incbin \\"%(filepath)s\\"\\n"
+    EMBEDDED_DATA_END);
+unsigned int %(name)s_len = %(length)iu;
+"""
+
+# Compressed data is inflated into the array on the first call to the
+# accessor, the program must link zlib.
+ZLIB_PREAMBLE = """#include <zlib.h>
+
+static bool embedded_data_inflate(
+    unsigned char *dst, unsigned long dst_len,
+    const unsigned char *src, unsigned long src_len) {
+  uLongf length = dst_len;
+  return dst_len == 0u ||
+      (uncompress(dst, &length, src, src_len) == Z_OK && length == dst_len);
+}
+
+"""
+
+ZLIB_ACCESSOR = """;
+unsigned char %(name)s[%(length)iu + 1u];
+unsigned int %(name)s_len = %(length)iu;
+const unsigned char *%(name)s_data() {
+  static const bool inflated = embedded_data_inflate(
+      %(name)s, %(name)s_len, %(name)s_zlib, sizeof(%(name)s_zlib) - 1u);
+  return inflated ? %(name)s : 0;
+}
+"""
+
+def _read_chunks(inputfile, size=READ_SIZE):
     with open(inputfile, 'rb') as fd:
-      hexdata = binascii.hexlify(fd.read())
-    chunks = ['0x' + hexdata[i:(i+chunksize)] for i in range(0, len(hexdata), chunksize)]
+        chunk = fd.read(size)
+        while chunk:
+            yield bytearray(chunk)
+            chunk = fd.read(size)
+
+def _write_array(out, inputfile, width=80, indent=2):
+    """Stream the bytes of inputfile as a C array initializer, as many per
+    line as fit in width. Returns the number of bytes."""
+    per_line = (width - indent + 1) // len('0x00, ')
     ind = ' ' * indent
-    return ind + ('\n'+ind).join(textwrap.wrap(', '.join(chunks), width-indent)), len(chunks)
+    length = 0
+    out.write(ind)
+    for chunk in _read_chunks(inputfile, per_line * (READ_SIZE // per_line)):
+        for start in range(0, len(chunk), per_line):
+            if length:
+                out.write(',\n' + ind)
+            line = chunk[start:start + per_line]
+            out.write(', '.join([BYTE_LITERALS[x] for x in line]))
+            length += len(line)
+    return length
+
+def _write_string(out, chunks, indent=2):
+    """Stream chunks as adjacent string literals, STRING_LINE_BYTES bytes per
+    line, much faster to parse than an array initializer. Returns the number
+    of bytes."""
+    ind = ' ' * indent
+    length = 0
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        lines = len(pending) // STRING_LINE_BYTES
+        for start in range(0, lines * STRING_LINE_BYTES, STRING_LINE_BYTES):
+            line = pending[start:start + STRING_LINE_BYTES]
+            out.write('\n%s"%s"' % (ind, ''.join([STRING_LITERALS[x] for x in line])))
+        length += lines * STRING_LINE_BYTES
+        del pending[:lines * STRING_LINE_BYTES]
+    if pending or not length:
+        out.write('\n%s"%s"' % (ind, ''.join([STRING_LITERALS[x] for x in pending])))
+    return length + len(pending)
+
+def _compress_chunks(inputfile, lengths):
+    """Compressed chunks of inputfile, appends its size to lengths"""
+    compressor = zlib.compressobj(9)
+    length = 0
+    for chunk in _read_chunks(inputfile):
+        length += len(chunk)
+        yield bytearray(compressor.compress(bytes(chunk)))
+    yield bytearray(compressor.flush())
+    lengths.append(length)
+
+def _file_digest(inputfile):
+    digest = hashlib.sha1()
+    for chunk in _read_chunks(inputfile):
+        digest.update(chunk)
+    return digest.hexdigest()
 
 def _get_variable_name(filepath):
     return filepath.replace('.', '_').replace('/', '_').lower()
 
+def get_encoding(target, item):
+    """Encoding of an embedded file, "embedded_data_encoding" of the target is
+    either an encoding or a dictionary of patterns, relative to the target
+    folder, to encodings. Patterns match as the ones of sources do, the
+    exact path wins over patterns and longer patterns over shorter ones."""
+    encoding = target.get('embedded_data_encoding') or 'array'
+    if isinstance(encoding, dict):
+        relpath = os.path.relpath(item, target.path).replace(os.sep, '/')
+        patterns = [x for x in encoding if util.glob_match(x, relpath)]
+        exact = [x for x in patterns if not glob.has_magic(x)]
+        patterns = exact or sorted(patterns, key=lambda x: (-len(x), x))
+        encoding = encoding[patterns[0]] if patterns else 'array'
+    if encoding not in ENCODINGS:
+        critical_error('Unknown encoding "%s" of %s', encoding, item)
+    return encoding
+
 class EmbeddedDataFile(object):
     def __init__(self, cppout, hout):
         self.cppout = cppout
         self.hout = hout
+        self._incbin = False
+        self._zlib = False
+
+    def add_array(self, name, inputfile):
+        self.cppout.write('unsigned char %s[] = {\n' % name)
+        length = _write_array(self.cppout, inputfile)
+        self.cppout.write('\n};\nunsigned int %s_len = %iu;\n' % (name, length))
+        self._add_declaration(name)
+
+    def add_string(self, name, inputfile):
+        """Data as string literals, the array keeps a null terminator."""
+        length = os.path.getsize(inputfile)
+        self.cppout.write('unsigned char %s[%iu + 1u] =' % (name, length))
+        _write_string(self.cppout, _read_chunks(inputfile))
+        self.cppout.write(';\nunsigned int %s_len = %iu;\n' % (name, length))
+        self._add_declaration(name)
+
+    def add_zlib(self, name, inputfile):
+        """Data compressed at embed time, name is filled by name_data()."""
+        if not self._zlib:
+            self.cppout.write(ZLIB_PREAMBLE)
+            self._zlib = True
+        lengths = []
+        self.cppout.write('static const unsigned char %s_zlib[] =' % name)
+        _write_string(self.cppout, _compress_chunks(inputfile, lengths))
+        self.cppout.write(ZLIB_ACCESSOR % {'name': name, 'length': lengths[0]})
+        self._add_declaration(name)
+        self.hout.write('const unsigned char *%s_data();\n' % name)
+
+    def add_incbin(self, name, inputfile):
+        """Let the assembler include inputfile as it is, the hash of the file
+        makes the source change along with it."""
+        if not self._incbin:
+            self.cppout.write(INCBIN_PREAMBLE)
+            self._incbin = True
+        self.cppout.write(INCBIN_FORMAT % {
+            'name': name,
+            'filepath': inputfile.replace('\\', '/'),
+            'sha1': _file_digest(inputfile),
+            'length': os.path.getsize(inputfile)})
+        self._add_declaration(name)
 
-    def add_data(self, name, data, length):
-        cppformat = 'unsigned char %s[] = {\n%s\n};\n'
-        cppformat += 'unsigned int %s_len = %iu;\n'
-        self.cppout.write(cppformat % (name, data, name, length))
+    def _add_declaration(self, name):
         hformat = 'extern unsigned char %s[];\n'
         hformat += 'extern unsigned int %s_len;\n'
         self.hout.write(hformat % (name, name))
@@ -44,19 +228,127 @@ def _mv_temp_file(tempf, dst):
     else:
       os.remove(tempf.name)
 
-def _embed_target(target, sourcedir):
-    cppfile_path = os.path.join(sourcedir, target.path, 'embedded_data.cpp')
-    hfile_path = os.path.join(sourcedir, target.path, 'embedded_data.h')
-    with tempfile.NamedTemporaryFile(delete=False) as cppfile:
-      with tempfile.NamedTemporaryFile(delete=False) as hfile:
-        writer = EmbeddedDataFile(cppfile, hfile)
-        for item in target["embedded_data"]:
-          data, length = _embed(os.path.join(sourcedir, item))
-          writer.add_data(_get_variable_name(item), data, length)
-        _mv_temp_file(cppfile, cppfile_path)
-        _mv_temp_file(hfile, hfile_path)
-
-def embed(targets, sourcedir):
+class EmbedError(Exception):
+    pass
+
+class Manifest(object):
+    """Encoding, mtime, size and hash of the files last embedded in each
+    folder, discarded when configure.pyz changes. Without filepath every
+    folder is out of date."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._entries = {}
+        if filepath is not None and os.path.isfile(filepath):
+            with open(filepath, 'r') as fd:
+                try:
+                    data = json.load(fd)
+                except ValueError as exception:
+                    logging.warning('Ignoring embed manifest %s: %s', filepath, exception)
+                    data = {}
+            if [data.get('version'), data.get('program')] == [MANIFEST_VERSION, util.get_version()]:
+                self._entries = data['targets']
+
+    def _get_inputs(self, sourcedir, items, previous):
+        inputs = []
+        for item, encoding in items:
+            stat = os.stat(os.path.join(sourcedir, item))
+            fingerprint = previous.get(item)
+            if fingerprint is None or fingerprint[:2] != [stat.st_mtime, stat.st_size]:
+                fingerprint = [stat.st_mtime, stat.st_size, _file_digest(os.path.join(sourcedir, item))]
+            inputs.append([item, encoding] + fingerprint)
+        return inputs
+
+    def is_changed(self, sourcedir, outdir, path, items):
+        """Whether the folder at path needs to embed items again, a list of
+        pairs of file and encoding"""
+        entry = self._entries.get(path)
+        if self.filepath is None or entry is None:
+            return True
+        for filename in ['embedded_data.cpp', 'embedded_data.h']:
+            if not os.path.isfile(os.path.join(outdir, path, filename)):
+                return True
+        previous = dict((x[0], x[2:]) for x in entry)
+        inputs = self._get_inputs(sourcedir, items, previous)
+        changed = [x[:2] + x[4:] for x in inputs] != [x[:2] + x[4:] for x in entry]
+        self._entries[path] = inputs
+        return changed
+
+    def update(self, sourcedir, path, items):
+        previous = dict((x[0], x[2:]) for x in self._entries.get(path, []))
+        self._entries[path] = self._get_inputs(sourcedir, items, previous)
+
+    def save(self):
+        if self.filepath is None:
+            return
+        data = {'version': MANIFEST_VERSION, 'program': util.get_version(), 'targets': self._entries}
+        util.write_if_changed(self.filepath, json.dumps(data, separators=(',', ':'), sort_keys=True))
+
+def _embed_target(args):
+    """Write the embedded data of a folder, run by the embed workers"""
+    sourcedir, outdir, path, items = args
+    start = time.time()
+    cppfile_path = os.path.join(outdir, path, 'embedded_data.cpp')
+    hfile_path = os.path.join(outdir, path, 'embedded_data.h')
+    try:
+      util.mkdir_p(os.path.join(outdir, path))
+      with tempfile.NamedTemporaryFile('w', delete=False) as cppfile:
+        with tempfile.NamedTemporaryFile('w', delete=False) as hfile:
+          writer = EmbeddedDataFile(cppfile, hfile)
+          for item, encoding in items:
+            name = _get_variable_name(item)
+            add = getattr(writer, 'add_' + encoding)
+            add(name, os.path.join(sourcedir, item))
+          _mv_temp_file(cppfile, cppfile_path)
+          _mv_temp_file(hfile, hfile_path)
+    except (IOError, OSError) as exception:
+      # Raised as a plain exception so the pool reports it.
+      raise EmbedError('Error embedding $sourcedir/%s: %s' % (path, exception))
+    size = sum(os.path.getsize(os.path.join(sourcedir, x)) for x, _ in items)
+    return EmbedResult(path, size, time.time() - start)
+
+def _print_report(results, skipped):
+    if not results:
+      print_out('Embedded data up to date, %i folders unchanged.' % skipped)
+      return
+    print_out('%-40s %12s %8s' % ('folder', 'bytes', 'seconds'))
+    for result in results:
+      print_out('%-40s %12i %8.2f' % (result.path or '.', result.size, result.seconds))
+    print_out('%i folders embedded, %i unchanged.' % (len(results), skipped))
+
+def embed(targets, sourcedir, outdir, jobs=1, manifest_path=None, report=True):
+    """Embed the data of the folders of targets whose files or encodings
+    changed since the last time, recorded in the manifest at manifest_path, in jobs
+    processes. The files of each folder are written to the same path in
+    outdir."""
+    manifest = Manifest(manifest_path)
+    # Targets of a folder share its embedded_data files.
+    folders = OrderedDict()
     for target in targets:
-      if target["embedded_data"]:
-        _embed_target(target, sourcedir)
+      for item in target["embedded_data"]:
+        encoding = get_encoding(target, item)
+        items = folders.setdefault(target.path, OrderedDict())
+        if items.setdefault(item, encoding) != encoding:
+          critical_error('%s embedded as both %s and %s', item, items[item], encoding)
+    pending = []
+    skipped = 0
+    for path, items in folders.items():
+      items = list(items.items())
+      if manifest.is_changed(sourcedir, outdir, path, items):
+        pending.append((sourcedir, outdir, path, items))
+      else:
+        skipped += 1
+    pool = util.create_pool(min(jobs, len(pending)), processes=True)
+    try:
+      results = util.pool_map(pool, _embed_target, pending)
+    except EmbedError as exception:
+      critical_error(exception)
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+    for _, _, path, items in pending:
+      manifest.update(sourcedir, path, items)
+    manifest.save()
+    if report:
+      _print_report(results, skipped)
@@ -10,6 +10,8 @@
 import textwrap
 import os
 
+import util
+
 from util import critical_error
 
 
@@ -69,33 +71,40 @@ def generate(command_call, ninja_targets, actions, settings, output_dir):
     remove_actions(['ninja', 'makefile', 'doxyfile', 'targets'], actions)
     makefile_settings = settings.get('makefile')
     filepath = os.path.join(output_dir, makefile_settings.get('filename', 'Makefile'))
-    ninja_command = 'ninja'
-    ninja_build_file = settings.get('ninja').get('filename', None)
-    if ninja_build_file is not None and ninja_build_file != 'build.ninja':
+    ninja_command = 'ninja $(NINJAFLAGS)'
+    ninja_build_file = settings.get('ninja').get('filename', 'build.ninja')
+    if ninja_build_file != 'build.ninja':
         ninja_command += ' -f ' + ninja_build_file
-    with open(filepath, 'w+') as out:
-        makefile = Writer(out)
-        makefile.comment(HEADER_COMMENT)
-        makefile.newline()
-        makefile.variable('CONFIG', ['python'] + command_call + ['$(FLAGS)'])
-        makefile.newline()
-        makefile.default(['build'])
-        makefile.newline()
-        makefile.phony(['configure'] + actions + ['doxygen'])
-        makefile.newline()
-        makefile.rule('configure', commands=['$(CONFIG) --ninja --makefile'])
-        makefile.newline()
-        makefile.rule('build', ['configure'], [ninja_command])
+    out = util.StringIO()
+    makefile = Writer(out)
+    makefile.comment(HEADER_COMMENT)
+    makefile.newline()
+    makefile.variable('CONFIG', ['python'] + command_call + ['$(FLAGS)'])
+    makefile.newline()
+    makefile.default(['build'])
+    makefile.newline()
+    global_targets = [x.phony_name for x in ninja_targets.global_targets]
+    # None is a file, though a folder may have the same name, e.g. build.
+    makefile.phony(
+        ['default', 'configure', 'build', 'clean'] + actions + ['doxygen'] + global_targets)
+    makefile.newline()
+    makefile.rule('configure', commands=['$(CONFIG) --ninja --makefile'])
+    makefile.newline()
+    # Only generated if missing, ninja takes care of regenerating it.
+    makefile.rule(ninja_build_file, commands=['$(CONFIG) --ninja --makefile'])
+    makefile.newline()
+    makefile.rule('build', [ninja_build_file], [ninja_command])
+    makefile.newline()
+    makefile.rule('clean', commands=[ninja_command + ' -t clean'])
+    for action in actions:
         makefile.newline()
-        makefile.rule('clean', commands=[ninja_command + ' -t clean'])
-        for action in actions:
-            makefile.newline()
-            commands = ['$(CONFIG) --' + action]
-            makefile.rule(action, commands=commands)
+        commands = ['$(CONFIG) --' + action]
+        makefile.rule(action, commands=commands)
+    makefile.newline()
+    doxyfile = settings.expand_variables('$builddir/Doxyfile')
+    makefile.rule('doxygen', commands=['$(CONFIG) --doxyfile', 'doxygen ' + doxyfile])
+    for target in ninja_targets.global_targets:
         makefile.newline()
-        doxyfile = settings.expand_variables('$builddir/Doxyfile')
-        makefile.rule('doxygen', commands=['$(CONFIG) --doxyfile', 'doxygen ' + doxyfile])
-        for target in ninja_targets.global_targets:
-            makefile.newline()
-            commands = [ninja_command + ' ' + target.phony_name]
-            makefile.rule(target.phony_name, ['configure'], commands)
+        commands = [ninja_command + ' ' + target.phony_name]
+        makefile.rule(target.phony_name, [ninja_build_file], commands)
+    util.write_if_changed(filepath, out.getvalue())
@@ -7,33 +7,82 @@
 
 """Generate build.ninja file"""
 
+import hashlib
 import logging
 import os
 import platform
+import re
 
 from collections import namedtuple
+from collections import OrderedDict
 
 import ninja_syntax
+import tracing
+import util
 
-from util import get_resource
+from configure import EMBEDDED_DATA_DIR
+from configure import EMBEDDED_DATA_FILES
+from configure import Path
+from util import critical_error
 
 
 HEADER_COMMENT = 'File automatically generated by configure.pyz, do not modify'
 
 EXECUTABLE_EXT = '.exe' if platform.system().lower() == 'windows' else ''
 
+SHARED_LIBRARY_EXT = '.so'
+
+TOC_EXT = '.TOC'
+
+
 BuildTarget = namedtuple('BuildTarget', 'config, name, phony_name')
 GlobalTarget = namedtuple('GlobalTarget', 'phony_name')
 
+TARGET_TYPES = ['executable', 'static_library', 'shared_library']
+
+RULE_FIELDS = [
+    'command', 'description', 'depfile', 'deps', 'msvc_deps_prefix', 'generator',
+    'pool', 'restat', 'rspfile', 'rspfile_content']
+
 NinjaTargets = namedtuple('NinjaTargets', 'build_targets, global_targets')
 
+Regeneration = namedtuple('Regeneration', 'command, inputs, outputs')
+
+Embedding = namedtuple('Embedding', 'command, inputs')
+
+ProfileTraining = namedtuple('ProfileTraining', 'command, profile_dir, merge_command, profile')
+
+DEFAULT_POOLS = {'link': {'depth': 'auto', 'memory_per_job': 2048}}
+
+DEFAULT_UNITY = {'files': 8}
+
+# "$$", "${name}" or "$name" as ninja parses them.
+VARIABLE_REFERENCE = re.compile(r'\$(?:\$|\{([\w.-]+)\}|([\w-]+))')
+
+UnityBuild = namedtuple('UnityBuild', 'units, sources')
+
+
+# Extension of the precompiled header and flag to use it, by compiler family.
+PRECOMPILED_HEADERS = {
+    'gcc': ('.gch', '-include $obj/%s'),
+    'clang': ('.pch', '-include-pch $obj/%s.pch')}
+
 
 class Ninja(object):
-    def __init__(self, out):
+    def __init__(self, out, compiler_family='gcc'):
         self._writer = ninja_syntax.Writer(out)
+        self._compiler_family = compiler_family
         self._writer.comment(HEADER_COMMENT)
         self._current_config = None
-        self._targets = {}
+        self._pools = {}
+        self._launcher = None
+        self._rpath = '.'
+        self._split_dwarf = False
+        self._archiver = None
+        self._profile = None
+        self._targets = OrderedDict()
+        self._libraries = OrderedDict()
+        self._embedded = {}
 
     def newline(self):
         self._writer.newline()
@@ -42,92 +91,466 @@ class Ninja(object):
         self._writer.newline()
         self._writer.include(include)
 
+    def add_rules(self, rules):
+        for name in sorted(rules):
+            fields = dict(rules[name])
+            msvc_deps_prefix = fields.pop('msvc_deps_prefix', None)
+            self._writer.newline()
+            self._writer.rule(name, **fields)
+            self._writer.variable('msvc_deps_prefix', msvc_deps_prefix, indent=1)
+
+    def add_pools(self, pools):
+        self._writer.newline()
+        for name in sorted(pools):
+            self._writer.pool(name, pools[name])
+
     def add_variables(self, dictionary):
         self._writer.newline()
-        for key, value in dictionary.items():
-            self._writer.variable(key, value)
+        for key in get_declaration_order(dictionary):
+            self._writer.variable(key, dictionary[key])
 
-    def open_configuration(self, name, bin, lib, obj):
+    def open_configuration(self, name, bin, lib, obj, pools=None, launcher=None, rpath='.',
+                           split_dwarf=False, archiver=None, profile=None):
+        """pools maps the pool names used by targets to the ones declared for
+        this configuration, rpath is the path of lib relative to bin. With
+        split_dwarf every object comes with a .dwo file. archiver replaces $ar
+        when set. Objects depend on profile, if any."""
         self._writer.newline()
         self._writer.comment(name)
         self.add_variables({'bin': bin, 'lib': lib, 'obj': obj})
         self._current_config = name
+        self._pools = pools or {}
+        self._launcher = launcher
+        self._rpath = rpath
+        self._split_dwarf = split_dwarf
+        self._archiver = archiver
+        self._profile = profile
         self._targets[name] = []
+        self._libraries[name] = []
+
+    def add_static_library(self, target, cflags=None, unity=None):
+        self._writer.newline()
+        objects = self._add_objects(target, cflags, unity)
+        out = '$lib/' + target['target_name']
+        variables = [('ar', self._archiver)] if self._archiver else []
+        self._writer.build(out, 'ar', objects, variables=variables)
+        self._add_library_phony(target, out)
 
-    def add_static_library(self, target, cflags=None):
+    def add_shared_library(self, target, cflags=None, lflags=None, unity=None):
+        """Position independent objects linked into a shared library, and its
+        table of contents. Dependents relink only when the latter changes."""
         self._writer.newline()
-        objects = [self._add_object_file(x, cflags) for x in target['sources']]
+        cflags = ' '.join(x for x in [cflags, '-fPIC'] if x)
+        objects = self._add_objects(target, cflags, unity)
         out = '$lib/' + target['target_name']
-        self._writer.build(out, 'ar', objects)
+        variables = [('soname', target['target_name'])]
+        self._add_link(out, 'solink', target, objects, lflags, '$$ORIGIN', variables)
+        self._writer.build(out + TOC_EXT, 'toc', out)
+        self._add_library_phony(target, out)
 
-    def add_executable(self, target, cflags=None, lflags=None):
+    def add_executable(self, target, cflags=None, lflags=None, unity=None):
         self._writer.newline()
         target_name = target['target_name']
-        deps = [self._add_object_file(x, cflags) for x in target['sources']]
-        inlibs = list(deps)
-        for item in target['dependencies']:
-            if not item.startswith('-l'):
-                inlibs.append('$lib/' + item)
-                deps.append('$lib/' + item)
-            else:
-                deps.append(item)
+        objects = self._add_objects(target, cflags, unity)
         out = '$bin/' + target_name + EXECUTABLE_EXT
-        variables = {'lflags': '$lflags ' + lflags} if lflags else {}
-        variables.update({'libs': ' '.join(deps)} if deps else {})
-        self._writer.build(out, 'link', inlibs, variables=variables)
+        rpath = '$$ORIGIN/' + self._rpath if self._rpath != '.' else '$$ORIGIN'
+        self._add_link(out, 'link', target, objects, lflags, rpath)
         phony_name = target_name + '_' + self._current_config
         self._writer.build(phony_name, 'phony', out)
         self._targets[self._current_config].append(phony_name)
         return BuildTarget(self._current_config, target_name, phony_name)
 
+    def add_embedded_data(self, targets, embedding, rules_files):
+        """Generate the embedded data of each folder in EMBEDDED_DATA_DIR
+        running the embedding command with the folder. It runs again when
+        the settings, the target rules file of the folder, given by
+        rules_files, or the folders of the embedded files change. Only
+        changed outputs are updated."""
+        inputs = OrderedDict()
+        for target in targets:
+            if target.get('embedded_data'):
+                inputs.setdefault(target.path, []).extend(target['embedded_data'])
+        if not inputs:
+            return
+        self._writer.newline()
+        self._writer.comment('embedded data')
+        self._writer.newline()
+        self._writer.rule(
+            'embed', embedding.command + ' $dir', description='EMBED $dir', restat=True)
+        for path, items in inputs.items():
+            items = sorted(set(items))
+            outputs = [Path.join(EMBEDDED_DATA_DIR, path, x) for x in EMBEDDED_DATA_FILES]
+            implicit = list(embedding.inputs)
+            implicit += [Path.join('$sourcedir', x) for x in rules_files.get(path, [])]
+            implicit += sorted(set(Path.join('$sourcedir', os.path.dirname(x)) for x in items))
+            self._writer.newline()
+            self._writer.build(
+                outputs, 'embed', ['$sourcedir/' + x for x in items], implicit=implicit,
+                variables=[('dir', path)])
+            self._embedded[path] = outputs
+
+    def add_profile_training(self, training):
+        """Run the training command once every binary of the current
+        configuration is built, and merge the profiles it leaves."""
+        self._writer.newline()
+        variables = [
+            ('profile_dir', training.profile_dir),
+            ('training', training.command),
+            ('merge', training.merge_command)]
+        self._writer.build(
+            training.profile, 'pgo_train', implicit=self._current_config, variables=variables)
+
     def add_global_targets(self):
+        """A phony per configuration building its executables, and the
+        libraries they link. Configurations without executables build all of
+        their libraries. "all" builds every target."""
         global_targets = []
         self._writer.newline()
         self._writer.comment('other targets')
         self._writer.newline()
         for name, targets in self._targets.items():
-            self._writer.build(name, 'phony', targets)
+            self._writer.build(name, 'phony', targets or self._libraries[name])
             global_targets.append(GlobalTarget(name))
         self._writer.newline()
-        self._writer.build('all', 'phony', self._targets.keys())
+        libraries = [x for y in self._libraries.values() for x in y]
+        self._writer.build('all', 'phony', list(self._targets.keys()) + libraries)
         global_targets.append(GlobalTarget('all'))
-        self._writer.default(self._targets.keys()[0])
+        self._writer.default(next(iter(self._targets)))
         return global_targets
 
-    def _add_object_file(self, source, cflags=None):
-        out = '$obj/%s.o' % os.path.splitext(source)[0]
-        variables = {'cflags': '$cflags ' + cflags} if cflags else None
-        self._writer.build(out, 'cxx', '$sourcedir/' + source, variables=variables)
+    def add_regeneration(self, regeneration):
+        """Generator edge re-running configure.pyz when its inputs change.
+        Missing inputs are phony so removing one triggers it too."""
+        self._writer.newline()
+        self._writer.comment('regenerate build files')
+        self._writer.newline()
+        self._writer.rule(
+            'configure',
+            regeneration.command,
+            description='CONFIGURE $out',
+            generator=True,
+            pool='console',
+            restat=True)
+        self._writer.newline()
+        self._writer.build(regeneration.outputs, 'configure', implicit=regeneration.inputs)
+        self._writer.newline()
+        for item in regeneration.inputs:
+            self._writer.build(item, 'phony')
+
+    def _get_pool(self, name):
+        if name is None or name == 'console':
+            return name
+        if name not in self._pools:
+            critical_error('Pool "%s" not declared in settings', name)
+        return self._pools[name]
+
+    def _add_library_phony(self, target, out):
+        phony_name = target['target_name'] + '_' + self._current_config
+        self._writer.build(phony_name, 'phony', out)
+        self._libraries[self._current_config].append(phony_name)
+
+    def _add_link(self, out, rule, target, objects, lflags=None, rpath=None, variables=[]):
+        """Link objects with the dependencies of target. Shared libraries are
+        found at runtime through rpath, relative to out, and only their table
+        of contents is a dependency of the link."""
+        inputs = list(objects)
+        implicit = []
+        libs = list(objects)
+        for item in target.get_link_dependencies():
+            if item.startswith('-l'):
+                libs.append(item)
+            elif item.endswith(SHARED_LIBRARY_EXT):
+                implicit.append('$lib/' + item + TOC_EXT)
+                libs.append('$lib/' + item)
+            else:
+                inputs.append('$lib/' + item)
+                libs.append('$lib/' + item)
+        if implicit and rpath is not None:
+            libs.append('-Wl,-rpath,' + rpath)
+        variables = list(variables)
+        variables += [('lflags', '$lflags ' + lflags)] if lflags else []
+        variables += [('libs', ' '.join(libs))] if libs else []
+        variables += [('pool', self._get_pool('link'))] if 'link' in self._pools else []
+        self._writer.build(out, rule, inputs, implicit=implicit, variables=variables)
+
+    def _add_precompiled_header(self, target, cflags=None, pool=None, order_only=None):
+        """Build the precompiled header of target, if any, with the same flags
+        as its objects. Returns the flags using it and the file built."""
+        header = target.get('precompiled_header')
+        if not header:
+            return cflags, None
+        extension, flag = PRECOMPILED_HEADERS[self._compiler_family]
+        out = '$obj/' + header + extension
+        variables = [('cflags', '$cflags ' + cflags)] if cflags else []
+        variables += [('pool', pool)] if pool else []
+        self._writer.build(
+            out, 'pch', '$sourcedir/' + header, implicit=self._profile, order_only=order_only,
+            variables=variables)
+        return ' '.join(x for x in [cflags, flag % header] if x), out
+
+    def _add_objects(self, target, cflags=None, unity=None):
+        """Object files of target, compiling the units of the unity build
+        instead of the sources merged in them. The embedded data of the
+        target folder, if any, is always the last object."""
+        pool = self._get_pool(target.get('pool'))
+        embedded = self._embedded.get(target.path) if target.get('embedded_data') else None
+        if embedded:
+            include = '-I' + Path.join(EMBEDDED_DATA_DIR, target.path)
+            cflags = ' '.join(x for x in [cflags, include] if x)
+        cflags, pch = self._add_precompiled_header(target, cflags, pool, embedded)
+        objects = []
+        for source in (target['sources'] if unity is None else unity.sources):
+            out = '$obj/%s.o' % os.path.splitext(source)[0]
+            objects.append(self._add_object_file(
+                out, '$sourcedir/' + source, cflags, pool, pch, embedded))
+        for unit in ([] if unity is None else unity.units):
+            out = '$obj/%s.o' % os.path.splitext(unit)[0]
+            objects.append(self._add_object_file(out, '$obj/' + unit, cflags, pool, pch, embedded))
+        if embedded:
+            # Named after the target, the folder may have several built with other flags.
+            name = os.path.splitext(target['target_name'])[0]
+            out = '$obj/%s.embedded_data.o' % Path.join(target.path, name)
+            objects.append(self._add_object_file(out, embedded[0], cflags, pool, pch, embedded))
+        return objects
+
+    def _add_object_file(self, out, source, cflags=None, pool=None, pch=None, order_only=None):
+        variables = [('cflags', '$cflags ' + cflags)] if cflags else []
+        variables += [('pool', pool)] if pool else []
+        variables += [('launcher', self._launcher)] if self._launcher else []
+        dwo = os.path.splitext(out)[0] + '.dwo' if self._split_dwarf else None
+        implicit = [x for x in [pch, self._profile] if x]
+        self._writer.build(
+            out, 'cxx', source, implicit=implicit, order_only=order_only, variables=variables,
+            implicit_outputs=dwo)
         return out
 
 
-def generate(targets, settings, compiler, output_dir):
+def get_declaration_order(variables):
+    """Names of variables sorted, except that each comes after the ones its
+    value references, as ninja expands top-level variables where declared"""
+    order = []
+    def visit(name, stack):
+        if name in order or name in stack:
+            return
+        stack.append(name)
+        for match in VARIABLE_REFERENCE.finditer(str(variables[name])):
+            reference = match.group(1) or match.group(2)
+            if reference in variables:
+                visit(reference, stack)
+        stack.pop()
+        order.append(name)
+    for name in sorted(variables):
+        visit(name, [])
+    return order
+
+
+def get_rules(ninja_settings):
+    """Default rules updated with the ones in settings. A rule or a field set
+    to null in settings is removed."""
+    rules = {}
+    if ninja_settings.get('add_default_rules', True):
+        rules = dict(util.load_yaml_resource('defaults/rules.yaml'))
+    for name, fields in (ninja_settings.get('rules', None) or {}).items():
+        if fields is None:
+            rules.pop(name, None)
+            continue
+        rule = dict(rules.get(name, {}))
+        rule.update(fields)
+        rules[name] = dict((k, v) for k, v in rule.items() if v is not None)
+    for name, fields in rules.items():
+        unknown = [x for x in fields if x not in RULE_FIELDS]
+        if unknown:
+            critical_error('Unknown fields in rule "%s": %s', name, ', '.join(sorted(unknown)))
+        if not fields.get('command'):
+            critical_error('Missing command in rule "%s"', name)
+    return rules
+
+
+def _as_pool_dict(pool):
+    return pool if isinstance(pool, dict) else {'depth': pool}
+
+
+def get_pool_depth(name, pool):
+    """Depth of a pool in settings: a number, "auto", or a dictionary with
+    "depth" and "memory_per_job" (in megabytes). Automatic depths run as many
+    jobs as CPUs, as long as physical memory is enough for them. Total memory
+    is used, not the free one, so that the depth does not change across runs."""
+    pool = _as_pool_dict(pool)
+    depth = pool.get('depth', 'auto')
+    if depth != 'auto':
+        if not isinstance(depth, int) or depth < 1:
+            critical_error('Invalid depth of pool "%s": %s', name, depth)
+        return depth
+    depth = util.cpu_count()
+    memory = util.physical_memory()
+    if memory is not None and pool.get('memory_per_job'):
+        depth = min(depth, memory // (pool['memory_per_job'] * 1024 * 1024))
+    logging.info('Pool "%s" depth set to %i', name, max(1, depth))
+    return max(1, depth)
+
+
+def get_pools(ninja_settings, configurations):
+    """Pools to declare, and for each configuration the pool to use for each
+    pool name. Configurations may override the depth of a pool, then a pool
+    suffixed with the configuration name is declared for it."""
+    settings_pools = dict(DEFAULT_POOLS)
+    for name, pool in (ninja_settings.get('pools', None) or {}).items():
+        if pool is None:
+            settings_pools.pop(name, None)
+        else:
+            settings_pools[name] = dict(DEFAULT_POOLS.get(name, {}), **_as_pool_dict(pool))
+    pools = dict((k, get_pool_depth(k, v)) for k, v in settings_pools.items())
+    config_pools = {}
+    for config in configurations:
+        config_pools[config.name] = dict((x, x) for x in pools)
+        for name, pool in config.pools.items():
+            if name not in pools:
+                critical_error('Pool "%s" of configuration "%s" not declared', name, config.name)
+            pool = dict(_as_pool_dict(settings_pools[name]), **_as_pool_dict(pool))
+            config_pool = '%s_%s' % (name, config.name)
+            pools[config_pool] = get_pool_depth(config_pool, pool)
+            config_pools[config.name][name] = config_pool
+    return pools, config_pools
+
+
+def get_unity(config, target):
+    """Unity build settings of target in config, None if disabled. Both the
+    configuration and the target may set "unity" to a boolean or to a
+    dictionary with "files", the target takes precedence."""
+    unity = dict(DEFAULT_UNITY)
+    enabled = False
+    for value in [config.unity, target.get('unity')]:
+        if value is None:
+            continue
+        enabled = value is not False
+        if isinstance(value, dict):
+            unity.update(value)
+    if not enabled:
+        return None
+    if not isinstance(unity['files'], int) or unity['files'] < 1:
+        critical_error('Invalid number of files of unity build: %s', unity['files'])
+    return unity
+
+
+def _hash(string):
+    return int(hashlib.sha1(string.encode('utf-8')).hexdigest()[:8], 16)
+
+
+def group_unity_sources(sources, files):
+    """Split the sorted sources in groups of files sources on average. A group
+    starts at every source whose path hashes to a multiple of files, so adding
+    or removing a source only changes the group it belongs to. Groups are also
+    split before getting twice files sources."""
+    groups = []
+    for source in sorted(sources):
+        if groups and _hash(source) % files != 0 and len(groups[-1]) < 2 * files:
+            groups[-1].append(source)
+        else:
+            groups.append([source])
+    return groups
+
+
+def _update_unity_list(filepath, units, objdir):
+    """Record the units of a target in filepath, removing the ones of the
+    previous layout"""
+    if os.path.isfile(filepath):
+        with open(filepath, 'r') as fd:
+            previous = fd.read().splitlines()
+        for unit in set(previous) - set(units):
+            if os.path.isfile(os.path.join(objdir, unit)):
+                os.remove(os.path.join(objdir, unit))
+    if units or os.path.isfile(filepath):
+        util.mkdir_p(os.path.dirname(filepath) or '.')
+        util.write_if_changed(filepath, ''.join(x + '\n' for x in units))
+
+
+def write_unity_build(target, unity, sourcedir, objdir):
+    """Write the unity units of target into objdir, named after the first
+    source of each group. Sources excluded or alone in their group are built
+    on their own."""
+    excluded = set(target.get('unity_exclude') or [])
+    merged = [x for x in target['sources'] if x not in excluded]
+    units = []
+    sources = [x for x in target['sources'] if x in excluded]
+    for group in group_unity_sources(merged, unity['files']):
+        if len(group) == 1:
+            sources.append(group[0])
+            continue
+        unit = os.path.splitext(group[0])[0] + '.unity.cpp'
+        unit_dir = os.path.dirname(os.path.join(objdir, unit))
+        includes = [os.path.relpath(os.path.join(sourcedir, x), unit_dir) for x in group]
+        content = ''.join('#include "%s"\n' % x.replace('\\', '/') for x in includes)
+        util.mkdir_p(unit_dir)
+        util.write_if_changed(os.path.join(objdir, unit), '// %s\n%s' % (HEADER_COMMENT, content))
+        units.append(unit)
+    unity_list = os.path.join(objdir, target.path, target['target_name'] + '.unity')
+    _update_unity_list(unity_list, units, objdir)
+    return UnityBuild(units, sorted(sources))
+
+
+def get_rules_files(targets, settings):
+    """Target rules file of the folder of each target, if it has one"""
+    filename = settings.get('targets')['filename']
+    sourcedir = settings.expand_variables('$sourcedir')
+    paths = set(x.path for x in targets)
+    return dict((x, [Path.join(x, filename)]) for x in paths
+                if os.path.isfile(os.path.join(sourcedir, x, filename)))
+
+
+def generate(targets, settings, compiler, output_dir, regeneration=None, embedding=None):
     build_targets = []
     ninja_settings = settings.get('ninja')
     filepath = os.path.join(output_dir, ninja_settings.get('filename', 'build.ninja'))
-    with open(filepath, 'w+') as out:
-        ninja = Ninja(out)
-        if ninja_settings.get('add_default_rules', True):
-            ninja.newline()
-            out.write(get_resource('defaults/rules.ninja'))
-        if ninja_settings.get('include_file', None) is not None:
-            ninja.add_include(ninja_settings['include_file'])
-        ninja.add_variables(settings.get('variables'))
-        ninja.add_variables(compiler.get_global_variables())
-        for config in compiler.get_configurations():
-            ninja.open_configuration(config.name, config.bin, config.lib, config.obj)
-            for target in targets:
-                if not target['headers'] and not target['sources']:
-                    continue
-                target_type = target['type']
-                cflags = config.cflags + ' ' + compiler.get_compiler_flags(target.raw)
-                if target_type == 'executable':
-                    lflags = config.lflags + ' ' + compiler.get_linker_flags(target.raw)
-                    btarget = ninja.add_executable(target, cflags.strip(), lflags.strip())
-                    build_targets.append(btarget)
-                elif target_type == 'static_library':
-                    ninja.add_static_library(target, cflags.strip())
-                else:
-                    logging.warning('Target ignored: type "%s" not implemented', target_type)
-        global_targets = ninja.add_global_targets()
+    out = util.StringIO()
+    ninja = Ninja(out, compiler.get_family())
+    ninja.add_rules(get_rules(ninja_settings))
+    pools, config_pools = get_pools(ninja_settings, compiler.get_configurations())
+    ninja.add_pools(pools)
+    if ninja_settings.get('include_file', None) is not None:
+        ninja.add_include(ninja_settings['include_file'])
+    ninja.add_variables(settings.get('variables'))
+    ninja.add_variables(compiler.get_global_variables())
+    if embedding is not None:
+        embedded = [x for x in targets if x.get('embedded_data')]
+        ninja.add_embedded_data(embedded, embedding, get_rules_files(embedded, settings))
+    sourcedir = settings.expand_variables('$sourcedir')
+    unity_files = []
+    for config in compiler.get_configurations():
+        rpath = os.path.relpath(
+            settings.expand_variables(config.lib), settings.expand_variables(config.bin))
+        ninja.open_configuration(
+            config.name, config.bin, config.lib, config.obj, config_pools[config.name],
+            config.launcher, rpath.replace('\\', '/'), config.split_dwarf, config.archiver,
+            config.profile)
+        objdir = settings.expand_variables(config.obj)
+        for target in targets:
+            if not target['headers'] and not target['sources']:
+                continue
+            target_type = target['type']
+            cflags = config.cflags + ' ' + compiler.get_compiler_flags(target.raw)
+            unity = get_unity(config, target)
+            if unity is not None and target_type in TARGET_TYPES:
+                unity = write_unity_build(target, unity, sourcedir, objdir)
+                unity_files += [Path.join(objdir, x) for x in unity.units]
+            if target_type == 'executable':
+                lflags = config.lflags + ' ' + compiler.get_linker_flags(target.raw)
+                btarget = ninja.add_executable(target, cflags.strip(), lflags.strip(), unity)
+                build_targets.append(btarget)
+            elif target_type == 'static_library':
+                ninja.add_static_library(target, cflags.strip(), unity)
+            elif target_type == 'shared_library':
+                lflags = config.lflags + ' ' + compiler.get_linker_flags(target.raw)
+                ninja.add_shared_library(target, cflags.strip(), lflags.strip(), unity)
+            else:
+                logging.warning('Target ignored: type "%s" not implemented', target_type)
+        if config.training is not None:
+            ninja.add_profile_training(config.training)
+    global_targets = ninja.add_global_targets()
+    if regeneration is not None:
+        # Configure writes the unity units, so it recreates them if missing.
+        outputs = regeneration.outputs + unity_files
+        ninja.add_regeneration(regeneration._replace(outputs=outputs))
+    content = out.getvalue()
+    tracing.count('ninja edges', content.count('\nbuild '))
+    util.write_if_changed(filepath, content)
     return NinjaTargets(build_targets, global_targets)
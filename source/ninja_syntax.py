@@ -58,11 +58,17 @@ class Writer(object):
             self.variable('deps', deps, indent=1)
 
     def build(self, outputs, rule, inputs=None, implicit=None, order_only=None,
-              variables=None):
+              variables=None, implicit_outputs=None):
         outputs = self._as_list(outputs)
         out_outputs = [escape_path(x) for x in outputs]
         all_inputs = [escape_path(x) for x in self._as_list(inputs)]
 
+        if implicit_outputs:
+            implicit_outputs = [escape_path(x)
+                                for x in self._as_list(implicit_outputs)]
+            out_outputs.append('|')
+            out_outputs.extend(implicit_outputs)
+
         if implicit:
             implicit = [escape_path(x) for x in self._as_list(implicit)]
             all_inputs.append('|')
@@ -8,7 +8,6 @@
 """Generate Sublime Text project file"""
 
 import json
-import os
 import re
 
 from configure import Path
@@ -79,11 +78,9 @@ def generate(ninja_targets, settings):
 
     project = re.sub(
         r'(\$build_systems)',
-        json.dumps(build_systems, indent=4, separators=(',', ': ')),
+        json.dumps(build_systems, indent=4, separators=(',', ': '), sort_keys=True),
         template)
     project = settings.expand_variables(project)
 
     filename = settings.expand_variables('$projectsdir/$project_name.sublime-project')
-    util.mkdir_p(os.path.dirname(filename))
-    with open(filename, 'w+') as out:
-        out.write(project)
+    util.write_if_changed(filename, project)
@@ -0,0 +1,203 @@
+# configure.pyz Copyright (C) 2014 N. Subiron Montoro
+#
+# This program comes with ABSOLUTELY NO WARRANTY. This is free software, and you
+# are welcome to redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+
+"""Probe which flags the compiler and linker support"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+import util
+
+LINKERS = ['bfd', 'gold', 'lld', 'mold']
+
+# Archivers able to index LTO objects, by compiler family.
+LTO_ARCHIVERS = {'gcc': 'gcc-ar', 'clang': 'llvm-ar'}
+
+PROBE_SOURCE = 'int main() { return 0; }\n'
+
+# Probe results by compiler and flags, kept across runs in the document cache.
+_probes = {}
+
+
+def _run(command):
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return False
+    process.communicate()
+    return process.returncode == 0
+
+
+def _probe(cxx, cflags, lflags):
+    tempdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tempdir, 'probe.cpp')
+        with open(source, 'w') as fd:
+            fd.write(PROBE_SOURCE)
+        obj = os.path.join(tempdir, 'probe.o')
+        return (
+            _run([cxx, '-Werror'] + cflags + ['-c', source, '-o', obj]) and
+            _run([cxx] + lflags + [obj, '-o', os.path.join(tempdir, 'probe')]))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def supports(cxx, cflags=[], lflags=[]):
+    """Whether cxx compiles and links a trivial program with cflags and lflags.
+    Results are reused until the compiler changes."""
+    key = json.dumps([util.program_identity(cxx), cflags, lflags])
+    if key not in _probes:
+        cache = util.get_document_cache()
+        result = None if cache is None else cache.get('probe:' + key)
+        if result is None:
+            result = _probe(cxx, cflags, lflags)
+            logging.info('Probe %s %s: %s', cxx, ' '.join(cflags + lflags),
+                         'supported' if result else 'not supported')
+            if cache is not None:
+                cache.put('probe:' + key, result)
+        _probes[key] = result
+    return _probes[key]
+
+
+class DebugOptions(object):
+    """Linker and debug info options of a configuration, reduced to the ones
+    the compiler supports"""
+
+    def __init__(self, cxx, name, data):
+        self.cflags = []
+        self.lflags = []
+        self.split_dwarf = False
+        linker = data.get('linker', None)
+        if linker:
+            if linker not in LINKERS:
+                logging.warning('Configuration "%s": unknown linker "%s"', name, linker)
+            self._add(cxx, name, [], ['-fuse-ld=' + linker])
+        compress = data.get('compress_debug_sections', None)
+        if compress:
+            flag = '-gz' if compress is True else '-gz=' + compress
+            self._add(cxx, name, [flag], [flag])
+        if data.get('split_dwarf', False):
+            # Without debug info there would be no .dwo files to track.
+            self.split_dwarf = self._add(cxx, name, ['-g', '-gsplit-dwarf'], [])
+        if data.get('gdb_index', False):
+            self._add(cxx, name, [], ['-Wl,--gdb-index'])
+
+    def _add(self, cxx, name, cflags, lflags):
+        """Add the flags if supported along with the ones added so far"""
+        if not supports(cxx, self.cflags + cflags, self.lflags + lflags):
+            logging.warning(
+                'Configuration "%s": %s not supported by %s, ignored',
+                name, ' '.join(cflags + lflags), cxx)
+            return False
+        self.cflags += cflags
+        self.lflags += lflags
+        return True
+
+
+def get_tool(cxx, name):
+    """Name of a tool matching the version suffix of cxx, if any"""
+    match = re.search(r'-[0-9.]+$', os.path.basename(cxx))
+    return name + (match.group(0) if match else '')
+
+
+class LtoOptions(object):
+    """Link time optimization flags of a configuration. ThinLTO is used with
+    clang unless "full" is requested, gcc has full LTO only. Links run jobs
+    parallel LTO jobs, and ThinLTO keeps a cache of at most cache_size bytes
+    in cache_dir. Everything is left out if not supported along with the
+    linker flags of the configuration, base_lflags."""
+
+    def __init__(self, cxx, family, name, mode, jobs, cache_dir, cache_size, base_lflags=[]):
+        self.cflags = []
+        self.lflags = []
+        self.archiver = None
+        if mode not in [True, 'full', 'thin']:
+            logging.warning('Configuration "%s": unknown LTO mode "%s", ignored', name, mode)
+            return
+        if family == 'gcc':
+            if mode == 'thin':
+                logging.warning('Configuration "%s": %s has no ThinLTO, using full LTO', name, cxx)
+            cflags = ['-flto']
+            lflags = ['-flto=%i' % jobs]
+        elif mode == 'full':
+            # Full LTO runs a single job in clang.
+            cflags = ['-flto']
+            lflags = ['-flto']
+        else:
+            cflags = ['-flto=thin']
+            lld = '-fuse-ld=lld' in base_lflags
+            lflags = ['-flto=thin'] + self._thin_lto_lflags(jobs, cache_dir, cache_size, lld)
+        archiver = get_tool(cxx, LTO_ARCHIVERS[family])
+        if util.which(archiver) is None:
+            logging.warning('Configuration "%s": archiver %s not found, LTO ignored', name, archiver)
+        elif not supports(cxx, cflags, base_lflags + lflags):
+            logging.warning('Configuration "%s": LTO not supported by %s, ignored', name, cxx)
+        else:
+            self.cflags = cflags
+            self.lflags = lflags
+            self.archiver = archiver
+
+    @staticmethod
+    def _thin_lto_lflags(jobs, cache_dir, cache_size, lld):
+        policy = 'cache_size_bytes=%i' % cache_size
+        if lld:
+            options = ['--thinlto-jobs=%i', '--thinlto-cache-dir=%s', '--thinlto-cache-policy=%s']
+        else:
+            # LLVM gold plugin, also used by bfd and mold.
+            options = ['-plugin-opt,jobs=%i', '-plugin-opt,cache-dir=%s', '-plugin-opt,cache-policy=%s']
+        return ['-Wl,' + x % y for x, y in zip(options, [jobs, cache_dir, policy])]
+
+
+def _shell_abspath(path):
+    """Absolute path in a ninja command, relative ones are joined to $PWD"""
+    return path if os.path.isabs(path) else '$$PWD/' + path
+
+
+class PgoOptions(object):
+    """Profile guided optimization flags of a configuration built twice, first
+    instrumented in instrumented_obj and then optimized in optimized_obj. The
+    training run leaves its raw profiles in profile_dir, merged into profile.
+    Out of date profiles are not an error, the functions that changed are
+    just left unoptimized."""
+
+    def __init__(self, cxx, family, name, profile_dir, instrumented_obj, optimized_obj):
+        # Paths are relative to the build root, where ninja runs both the
+        # compiler and the training command.
+        self.profile_dir = profile_dir
+        self.generate_cflags = ['-fprofile-generate=' + profile_dir]
+        self.generate_lflags = ['-fprofile-generate=' + profile_dir]
+        probe_cflags = list(self.generate_cflags)
+        if family == 'gcc':
+            # .gcda files are named after the objects, relative to their obj.
+            # The prefix must be absolute, it is left to the shell of the
+            # compile command.
+            self.generate_cflags.append('-fprofile-prefix-path=' + _shell_abspath(instrumented_obj))
+            probe_cflags.append('-fprofile-prefix-path=' + os.path.abspath(instrumented_obj))
+            self.profile = profile_dir + '.stamp'
+            self.merge_command = 'touch ' + self.profile
+            self.use_cflags = [
+                '-fprofile-use=' + profile_dir,
+                '-fprofile-prefix-path=' + _shell_abspath(optimized_obj),
+                '-Wno-missing-profile',
+                '-Wno-coverage-mismatch']
+        else:
+            profdata = get_tool(cxx, 'llvm-profdata')
+            self.profile = profile_dir + '.profdata'
+            self.merge_command = '%s merge -output=%s %s/*.profraw' % (
+                profdata, self.profile, profile_dir)
+            self.use_cflags = [
+                '-fprofile-use=' + self.profile,
+                '-Wno-profile-instr-out-of-date',
+                '-Wno-profile-instr-unprofiled']
+        self.supported = supports(cxx, probe_cflags, self.generate_lflags)
+        if not self.supported:
+            logging.warning('Configuration "%s": PGO not supported by %s, ignored', name, cxx)
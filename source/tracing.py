@@ -0,0 +1,95 @@
+# configure.pyz Copyright (C) 2014 N. Subiron Montoro
+#
+# This program comes with ABSOLUTELY NO WARRANTY. This is free software, and you
+# are welcome to redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+
+"""Timed spans and counters of a configure run, written as Chrome trace events"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import util
+
+# Spans as (name, thread, start, duration, args), None while disabled. Spans
+# of worker processes are lost, the ones of worker threads are kept.
+_spans = None
+
+_counters = OrderedDict()
+
+_start = None
+
+
+def enable():
+    global _spans, _start
+    if _spans is None:
+        _spans = []
+        _start = time.time()
+
+
+@contextmanager
+def span(name, **args):
+    """Time the enclosed block as name, args are shown along with it"""
+    if _spans is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        thread = threading.current_thread().ident
+        _spans.append((name, thread, start, time.time() - start, args))
+
+
+def count(name, value=1):
+    if _spans is not None:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get_trace():
+    """Chrome trace event format, see chrome://tracing"""
+    pid = os.getpid()
+    events = []
+    for name, thread, start, duration, args in _spans:
+        events.append({
+            'name': name,
+            'ph': 'X',
+            'pid': pid,
+            'tid': thread,
+            'ts': int((start - _start) * 1e6),
+            'dur': int(duration * 1e6),
+            'args': args})
+    end = int((time.time() - _start) * 1e6)
+    for name, value in _counters.items():
+        events.append({'name': name, 'ph': 'C', 'pid': pid, 'ts': end, 'args': {name: value}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def log_summary():
+    """Log total, count and longest time of each span, and the counters"""
+    totals = OrderedDict()
+    for name, _, _, duration, _ in _spans:
+        total, calls, longest = totals.get(name, (0.0, 0, 0.0))
+        totals[name] = (total + duration, calls + 1, max(longest, duration))
+    logging.info('%-32s %10s %8s %10s', 'span', 'total (ms)', 'count', 'max (ms)')
+    for name, (total, calls, longest) in sorted(totals.items(), key=lambda x: -x[1][0]):
+        logging.info('%-32s %10.1f %8i %10.1f', name, total * 1e3, calls, longest * 1e3)
+    for name, value in _counters.items():
+        logging.info('%-32s %10i', name, value)
+
+
+def finish(filepath=None):
+    """Log the summary and write the trace to filepath, if any"""
+    if _spans is None:
+        return
+    log_summary()
+    if filepath is not None:
+        util.write_if_changed(filepath, json.dumps(get_trace()))
+        util.print_out('Trace saved to %s.' % filepath)
@@ -5,24 +5,52 @@
 # General Public License as published by the Free Software Foundation, either
 # version 3 of the License, or (at your option) any later version.
 
+import fnmatch
+import glob
 import json
+import json.scanner
 import logging
+import multiprocessing
 import os
 import pkgutil
 import re
+import shutil
 import sys
+import tempfile
 
+from multiprocessing.pool import ThreadPool
 
-from contextlib import contextmanager
+try:
+
+    from StringIO import StringIO
+
+except ImportError:
+
+    from io import StringIO
 
 try:
 
-    import yaml
+    from os import scandir
 
 except ImportError:
 
-    print('CRITICAL: requires PyYaml')
-    sys.exit(2)
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+EXCLUDE_DIRS = ['.git', '.hg', '.svn']
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+# PyYAML, imported on first use. Most runs get every document from the
+# document cache.
+_yaml = None
+
+# Cache used by the loaders below, see set_document_cache.
+_document_cache = None
 
 
 if sys.version_info[0] != 2:
@@ -48,72 +76,285 @@ def critical_error(message, *args):
     sys.exit(1)
 
 
-@contextmanager
-def pushd(directory):
-    """Context manager to temporally change working directory."""
-    cwd = os.getcwd()
-    try:
-        os.chdir(directory)
-        yield
-    finally:
-        os.chdir(cwd)
-
-
 def get_resource(filename):
     return pkgutil.get_data('__main__', filename).decode('utf-8')
 
 
-def remove_comments(string):
-    """Remove C comments from string. See http://stackoverflow.com/a/18381470"""
-    pattern = r'(\".*?\"|\'.*?\')|(/\*.*?\*/|//[^\r\n]*$)'
-    regex = re.compile(pattern, re.MULTILINE|re.DOTALL)
-    replacer = lambda match: match.group(1) if match.group(2) is None else ''
-    return regex.sub(replacer, string)
+def get_version():
+    try:
+        return get_resource('version.txt').strip()
+    except (IOError, AttributeError):
+        return 'unknown'
+
+
+# Tokens of JSON with comments that need attention, anything else is left as
+# it is. Strings go first so that comment markers and commas in them are kept.
+# Block comments cannot backtrack past their end.
+_JSON_COMMENT = r'//[^\n]*|/\*[^*]*\*+(?:[^*/][^*]*\*+)*/'
+_JSON_TOKENS = re.compile(r'''
+    (?P<string>"(?:[^"\\\n]|\\.)*")
+  | (?P<comment>%s)
+  | (?P<comma>,(?=(?:\s|%s)*[\]}]))
+''' % (_JSON_COMMENT, _JSON_COMMENT), re.VERBOSE)
+
+
+def _blank_json_token(match):
+    if match.lastgroup == 'string':
+        return match.group(0)
+    # Keep lines and columns of the rest of the document.
+    return re.sub(r'[^\n]', ' ', match.group(0))
+
+
+def _json_error(string):
+    """Error of decoding string with the pure Python scanner, which reports
+    the position of nested errors unlike the C one of Python 2"""
+    decoder = json.JSONDecoder(strict=False)
+    decoder.scan_once = json.scanner.py_make_scanner(decoder)
+    try:
+        decoder.decode(string)
+    except ValueError as exception:
+        message = str(exception)
+        if 'line ' in message:
+            return ValueError(message)
+        # Only top level errors come without position.
+        position = len(string) - len(string.lstrip())
+        line = string.count('\n', 0, position) + 1
+        column = position - string.rfind('\n', 0, position)
+        return ValueError('%s: line %i column %i (char %i)' % (message, line, column, position))
+    return None
+
+
+def loads_json_with_comments(string):
+    """Parse JSON with C and C++ comments and trailing commas in a single
+    pass. Errors report the line and column in string."""
+    string = _JSON_TOKENS.sub(_blank_json_token, string)
+    try:
+        return json.loads(string, strict=False)
+    except ValueError as exception:
+        if 'line ' in str(exception):
+            raise
+        raise _json_error(string) or exception
 
 
 def load_json(filepath):
     with open(filepath, 'r') as datafile:
         try:
-            return json.loads(remove_comments(datafile.read()))
+            return loads_json_with_comments(datafile.read())
         except Exception as exception:
             critical_error('Error parsing file %s\n%s', filepath, exception)
 
 
-def load_yaml(filepath):
+def _import_yaml():
+    global _yaml
+    if _yaml is None:
+        try:
+            import yaml
+        except ImportError:
+            print('CRITICAL: requires PyYaml')
+            sys.exit(2)
+        _yaml = yaml
+    return _yaml
+
+
+def _safe_load(stream):
+    """Parse a YAML document, with libyaml if available"""
+    yaml = _import_yaml()
+    return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+def set_document_cache(cache):
+    """Serve the documents of the loaders below from cache, an object with
+    load(filepath, parse) and load_resource(filename, parse) methods"""
+    global _document_cache
+    _document_cache = cache
+
+
+def get_document_cache():
+    return _document_cache
+
+
+def _parse_yaml(filepath):
     with open(filepath, 'r') as datafile:
         try:
-            return yaml.load(datafile)
+            return _safe_load(datafile)
         except Exception as exception:
             critical_error('Error parsing file %s\n%s', filepath, exception)
 
 
-def load_yaml_or_json(filepath):
+def _parse_yaml_resource(filename):
+    try:
+        return _safe_load(get_resource(filename))
+    except Exception as exception:
+        critical_error('Error parsing resource %s\n%s', filename, exception)
+
+
+def _parse_yaml_or_json(filepath):
     with open(filepath, 'r') as datafile:
         try:
             ext = os.path.splitext(filepath)[1]
             if any(ext == x for x in ['.yaml', '.yml']):
-                return yaml.load(datafile)
+                return _safe_load(datafile)
             else: # assume it may be a json file with c comments.
-                return yaml.load(remove_comments(datafile.read()).replace('\t', '  '))
+                return loads_json_with_comments(datafile.read())
         except Exception as exception:
             critical_error('Error parsing file %s\n%s', filepath, exception)
 
 
+def load_yaml(filepath):
+    if _document_cache is None:
+        return _parse_yaml(filepath)
+    return _document_cache.load(filepath, _parse_yaml)
+
+
+def load_yaml_resource(filename):
+    if _document_cache is None:
+        return _parse_yaml_resource(filename)
+    return _document_cache.load_resource(filename, _parse_yaml_resource)
+
+
+def load_yaml_or_json(filepath):
+    if _document_cache is None:
+        return _parse_yaml_or_json(filepath)
+    return _document_cache.load(filepath, _parse_yaml_or_json)
+
+
 def upper_first(string):
     return string[0].upper() + string[1:] if string else ''
 
 
+def parse_size(size):
+    """Size in bytes of a number with an optional K, M, G or T suffix"""
+    match = re.match(r'^\s*(\d+)\s*([KMGT]?)i?B?\s*$', str(size), re.IGNORECASE)
+    if match is None:
+        critical_error('Invalid size "%s"', size)
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+
 def mkdir_p(path):
     if not os.path.isdir(path):
         os.makedirs(path)
 
 
-def walk(root):
-    """Wrapper around os.walk"""
-    exclude_dirs = ['.git', '.hg', '.svn']
-    for path, dirs, files in os.walk(root):
-        dirs[:] = [d for d in dirs if d not in exclude_dirs]
-        yield path, files
+def write_if_changed(filepath, content):
+    """Atomically replace filepath with content, unless it has already this
+    content. Returns whether the file was written."""
+    mode = None
+    if os.path.isfile(filepath):
+        with open(filepath, 'r') as fd:
+            if fd.read() == content:
+                logging.info('Up to date: %s', filepath)
+                return False
+        mode = os.stat(filepath).st_mode & 0o777
+    if mode is None:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    directory = os.path.dirname(filepath) or '.'
+    mkdir_p(directory)
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as tempf:
+        tempf.write(content)
+    os.chmod(tempf.name, mode)
+    shutil.move(tempf.name, filepath)
+    print_out('Updated %s.' % filepath)
+    return True
+
+
+def listdir(path):
+    """Sorted subfolders and files of path. Like os.walk, symbolic links to
+    folders are neither files nor subfolders. EXCLUDE_DIRS are skipped."""
+    dirs, files = [], []
+    if scandir is not None:
+        for entry in scandir(path):
+            if not entry.is_dir():
+                files.append(entry.name)
+            elif not entry.is_symlink() and entry.name not in EXCLUDE_DIRS:
+                dirs.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            fullpath = os.path.join(path, name)
+            if not os.path.isdir(fullpath):
+                files.append(name)
+            elif not os.path.islink(fullpath) and name not in EXCLUDE_DIRS:
+                dirs.append(name)
+    dirs.sort()
+    files.sort()
+    return dirs, files
+
+
+GLOB_FLAGS = re.IGNORECASE if os.path.normcase('A') == 'a' else 0
+
+_glob_regexes = {}
+
+
+def glob_regex(part):
+    """Compiled regex of a path component of a glob pattern"""
+    if part not in _glob_regexes:
+        _glob_regexes[part] = re.compile(fnmatch.translate(part), GLOB_FLAGS)
+    return _glob_regexes[part]
+
+
+def glob_match(pattern, filepath):
+    """Whether the relative filepath matches pattern as glob does: wildcards
+    match neither "/" nor a leading "." unless the pattern starts with one"""
+    parts = [x for x in pattern.split('/') if x not in ['', '.']]
+    names = [x for x in filepath.split('/') if x not in ['', '.']]
+    if len(parts) != len(names):
+        return False
+    for part, name in zip(parts, names):
+        if not glob.has_magic(part):
+            if part != name:
+                return False
+        elif not glob_regex(part).match(name) or \
+                (name.startswith('.') and not part.startswith('.')):
+            return False
+    return True
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def physical_memory():
+    """Total physical memory in bytes, None if unknown."""
+    if os.path.isfile('/proc/meminfo'):
+        with open('/proc/meminfo', 'r') as fd:
+            for line in fd:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def create_pool(jobs, processes=False, initializer=None, initargs=()):
+    """Pool of jobs workers, None if there is no point in having one."""
+    if jobs < 2:
+        return None
+    if processes:
+        return multiprocessing.Pool(jobs, initializer, initargs)
+    return ThreadPool(jobs, initializer, initargs)
+
+
+def pool_map(pool, function, iterable):
+    """Ordered map over pool, or the builtin map if pool is None."""
+    if pool is None:
+        return list(map(function, iterable))
+    # Waiting with a timeout keeps the main thread responsive to Ctrl+C.
+    return pool.map_async(function, iterable).get(365 * 24 * 3600)
+
+
+def program_identity(program):
+    """Real path, size and mtime of program, or its name if not found"""
+    path = which(program) or program
+    try:
+        stat = os.stat(path)
+        return '%s:%i:%i' % (os.path.realpath(path), stat.st_size, int(stat.st_mtime))
+    except OSError:
+        return program
 
 
 def which(program):
@@ -5,21 +5,34 @@
 import argparse
 import fnmatch
 import logging
+import multiprocessing
 import os
 import re
+import shutil
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
-from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+
+class TestResult(object):
+    def __init__(self, name, output, seconds, error=None, copy=None):
+        self.name = name
+        self.output = output
+        self.seconds = seconds
+        self.error = error
+        self.copy = copy
 
 
 class Logger(object):
     def __init__(self, file_stream):
         self.file_stream = file_stream
-        self.current_test = 'null'
 
     def error(self, text):
-        text = '%s: %s' % (self.current_test, text)
         self._write('ERROR: %s' % text)
         logging.error(text)
 
@@ -27,15 +40,18 @@ class Logger(object):
         self._write('INFO: %s' % text)
         logging.info(text)
 
-    def log_new_test(self, filename, folder):
-        folder = os.path.basename(os.path.normpath(folder))
-        filename = os.path.splitext(filename)[0]
-        self.current_test = '.'.join([folder, filename])
-        text = '%s: running' % self.current_test
-        self.info(text)
+    def log_new_test(self, name):
+        self.info('%s: running' % name)
 
-    def success(self):
-        self.info('%s: success' % self.current_test)
+    def log_result(self, result):
+        self.log_new_test(result.name)
+        self.print_command_output(result.output, display_on_screen=result.error is not None)
+        if result.error is None:
+            self.info('%s: success (%.1f s)' % (result.name, result.seconds))
+        else:
+            self.error('%s: %s (%.1f s)' % (result.name, result.error, result.seconds))
+        if result.copy is not None:
+            self.info('%s: kept in %s' % (result.name, result.copy))
 
     def print_command_output(self, output, display_on_screen=False):
         self._write(output)
@@ -44,26 +60,71 @@ class Logger(object):
 
     def _write(self, text):
         self.file_stream.write(text + '\n')
-
-
-@contextmanager
-def pushd(directory):
-    """Context manager to temporally change working directory."""
-    cwd = os.getcwd()
+        self.file_stream.flush()
+
+
+def get_test_name(filename, folder):
+    folder = os.path.basename(os.path.normpath(folder))
+    return '.'.join([folder, os.path.splitext(filename)[0]])
+
+
+def copy_test(testdir, path, tempdir):
+    """Copy the folder of a test to tempdir, along with the files of testdir
+    (shared includes), keeping its path relative to testdir"""
+    for filename in os.listdir(testdir):
+        if os.path.isfile(os.path.join(testdir, filename)):
+            shutil.copy2(os.path.join(testdir, filename), tempdir)
+    copy = os.path.join(tempdir, os.path.relpath(path, testdir))
+    shutil.copytree(path, copy, symlinks=True)
+    return copy
+
+
+def run_script(filename, directory, environmet, timeout):
+    """Run a script in its own process group, killed after timeout seconds.
+    Returns its output and the error, None on success."""
+    process = subprocess.Popen(
+        './' + filename,
+        cwd=directory,
+        env=environmet,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        preexec_fn=os.setsid)
+    output = []
+    # Read in a thread so that the pipe does not fill up while waiting.
+    reader = threading.Thread(target=lambda: output.append(process.stdout.read()))
+    reader.start()
+    deadline = None if timeout is None else time.time() + timeout
+    error = None
+    while process.poll() is None:
+        if deadline is not None and time.time() > deadline:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            error = 'timeout after %i seconds' % timeout
+            break
+        time.sleep(0.05)
+    reader.join()
+    if error is None and process.returncode != 0:
+        error = 'exit status %i' % process.returncode
+    return b''.join(output).decode('utf-8', 'replace'), error
+
+
+def run_test(args):
+    """Run a test on a temporary copy of its folder, run by the test workers"""
+    filename, path, testdir, environmet, timeout, keep = args
+    name = get_test_name(filename, path)
+    tempdir = tempfile.mkdtemp(prefix='configure_test_')
+    start = time.time()
+    output = ''
     try:
-        os.chdir(directory)
-        yield
-    finally:
-        os.chdir(cwd)
-
-
-def run_test(filename, directory, environmet):
-    filename = './' + filename
-    with pushd(directory):
-        return subprocess.check_output(
-            filename,
-            env=environmet,
-            stderr=subprocess.STDOUT).decode('utf-8')
+        copy = copy_test(testdir, path, tempdir)
+        output, error = run_script(filename, copy, environmet, timeout)
+    except Exception as exception:
+        error = str(exception)
+    seconds = time.time() - start
+    if error is not None and keep:
+        return TestResult(name, output, seconds, error, tempdir)
+    shutil.rmtree(tempdir, ignore_errors=True)
+    return TestResult(name, output, seconds, error)
 
 
 def source_walk(root, file_pattern):
@@ -89,6 +150,27 @@ def do_the_test():
         dest='log_file',
         default='./test.log',
         help='log file path')
+    argparser.add_argument(
+        '-j', '--jobs',
+        metavar='N',
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help='number of tests run in parallel, defaults to the number of CPUs')
+    argparser.add_argument(
+        '-k', '--filter',
+        metavar='PATTERN',
+        action='append',
+        dest='filters',
+        help='run only the tests named like PATTERN, e.g. "standard.*" (can have wild cards, repeatable)')
+    argparser.add_argument(
+        '--timeout',
+        metavar='SECONDS',
+        type=int,
+        help='kill a test running longer than SECONDS')
+    argparser.add_argument(
+        '--keep',
+        action='store_true',
+        help='keep the copy of the failing tests')
     argparser.add_argument(
         'configure_pyz_path',
         help='path to the configure.pyz to test')
@@ -104,25 +186,33 @@ def do_the_test():
         logging.critical('"%s" is not a directory', args.testdir)
         return
 
+    testdir = os.path.abspath(args.testdir)
+    environmet = dict(os.environ)
+    environmet['CONFIGURE_PYZ'] = os.path.abspath(args.configure_pyz_path)
+    tests = []
+    for filename, path in source_walk(testdir, args.script_filename):
+        name = get_test_name(filename, path)
+        if args.filters and not any(fnmatch.fnmatch(name, x) for x in args.filters):
+            continue
+        tests.append((filename, path, testdir, environmet, args.timeout, args.keep))
+
     with open(args.log_file, 'w+') as file_stream:
         logger = Logger(file_stream)
-
-        environmet = dict(os.environ)
-        environmet['CONFIGURE_PYZ'] = os.path.abspath(args.configure_pyz_path)
-        for filename, path in source_walk(args.testdir, args.script_filename):
-            try:
-                logger.log_new_test(filename, path)
-                output = run_test(filename, path, environmet)
-                logger.print_command_output(output)
-                logger.success()
-            except subprocess.CalledProcessError as exception:
-                logger.print_command_output(exception.output, display_on_screen=True)
-                logger.error(exception)
-                sys.exit(1)
-            except Exception as exception:
-                logger.error(exception)
-                sys.exit(2)
-
+        logger.info('running %i tests, %i at a time' % (len(tests), args.jobs))
+        failures = []
+        pool = ThreadPool(max(1, min(args.jobs, len(tests))))
+        try:
+            for result in pool.imap(run_test, tests):
+                logger.log_result(result)
+                if result.error is not None:
+                    failures.append(result.name)
+        finally:
+            pool.close()
+            pool.join()
+
+        if failures:
+            logger.error('%i of %i tests failed: %s' % (len(failures), len(tests), ', '.join(failures)))
+            sys.exit(1)
         logger.info("every test terminated successfully")
 
 
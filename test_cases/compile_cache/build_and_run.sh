@@ -0,0 +1,58 @@
+#!/bin/bash
+source ../header.include
+
+rm -Rf bin build projects source compile_cache
+rm -f build.ninja Makefile configure.yaml
+
+$CONFIGURE_PYZ -d --hello-world
+sed -i -e 's|launcher: null|launcher: builtin|' -e 's|~/.cache/configure.pyz|compile_cache|' configure.yaml
+$CONFIGURE_PYZ -d --makefile
+
+make all
+./build/bin_debug/hello_world
+./bin/hello_world
+$CONFIGURE_PYZ --cache-dir compile_cache --cache-stats
+
+# Rebuilt from the cache.
+make clean
+make all
+./build/bin_debug/hello_world
+./bin/hello_world
+$CONFIGURE_PYZ --cache-dir compile_cache --cache-stats | grep 'hits *[1-9]'
+
+# Sources with .incbin are not cached, the preprocessor does not see the data.
+# Both targets of the folder compile its embedded data.
+mkdir -p source/hello_world/res
+echo -n AAAA > source/hello_world/res/d.txt
+cat > source/hello_world/targets.json <<'RULES'
+{
+  "targets": [{
+    "target_name": "hello_world",
+    "type": "executable",
+    "sources": ["hello_world.cpp"],
+    "embedded_data": ["res/*"],
+    "embedded_data_encoding": "incbin"
+  }, {
+    "target_name": "resources",
+    "sources": ["resources.cpp"],
+    "embedded_data": ["res/*"],
+    "embedded_data_encoding": "incbin"
+  }]
+}
+RULES
+cat > source/hello_world/hello_world.cpp <<'SOURCE'
+#include "embedded_data.h"
+
+#include <iostream>
+#include <string>
+
+int main() {
+  std::cout << std::string(hello_world_res_d_txt, hello_world_res_d_txt + hello_world_res_d_txt_len) << std::endl;
+}
+SOURCE
+echo 'int resources() { return 0; }' > source/hello_world/resources.cpp
+make all
+./bin/hello_world | grep AAAA
+echo -n BBBB > source/hello_world/res/d.txt
+make all
+./bin/hello_world | grep BBBB
@@ -20,3 +20,8 @@ make clean
 make all
 ./build/bin_debug/hello_world
 ./bin/hello_world
+
+# A plain make rebuilds what changed, though a "build" folder exists.
+sed -i 's/Hello World!/Hello again!/' source/hello_world/hello_world.cpp
+make
+./bin/hello_world | grep 'Hello again!'
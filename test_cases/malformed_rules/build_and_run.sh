@@ -0,0 +1,23 @@
+#!/bin/bash
+source ../header.include
+
+rm -Rf bin build projects source
+rm -f build.ninja Makefile configure.yaml configure.log
+
+$CONFIGURE_PYZ -d --hello-world
+
+# A missing value on line 4 must be reported with its position.
+cat > source/hello_world/targets.json <<'RULES'
+{
+  // Comments and trailing commas are fine.
+  "targets": [{
+    "target_name": ,
+    "type": "executable",
+  }]
+}
+RULES
+if $CONFIGURE_PYZ --ninja > configure.log 2>&1; then
+  exit 1
+fi
+cat configure.log
+grep 'line 4 column 20' configure.log
@@ -3,16 +3,21 @@ source ../header.include
 
 rm -Rf bin build projects
 rm -f build.ninja Makefile configure.yaml
-find . -regex '.*embedded_data\.\(h\|cpp\)' -delete
+
+# Runs an executable and checks its output, embedded data included.
+check() {
+  "$1" > output.txt
+  diff expected_output.txt output.txt
+}
 
 $CONFIGURE_PYZ -d -g --targets --makefile
 
 make embed
 make debug
-./build/bin_debug/myexe
+check ./build/bin_debug/myexe
 
 make release
-./bin/myexe
+check ./bin/myexe
 
 make sublime
 make codeblocks
@@ -20,17 +25,19 @@ make doxygen
 
 make clean
 make all
-./build/bin_debug/myexe
-./bin/myexe
+check ./build/bin_debug/myexe
+check ./bin/myexe
 
+# Embedded data generated by ninja this time.
 $CONFIGURE_PYZ -d -f configure.variant.yaml --targets --makefile
 
-make embed
 make debug
-./build/variant/bin_debug/myexe
+check ./build/variant/bin_debug/myexe
+# Nothing left to do, embedded data included.
+ninja build/variant/bin_debug/myexe | grep 'no work to do'
 
 make release
-./build/variant/bin_release/myexe
+check ./build/variant/bin_release/myexe
 
 make sublime
 make codeblocks
@@ -38,5 +45,5 @@ make doxygen
 
 make clean
 make all
-./build/variant/bin_debug/myexe
-./build/variant/bin_release/myexe
+check ./build/variant/bin_debug/myexe
+check ./build/variant/bin_release/myexe
@@ -1,5 +1,7 @@
 #include <mylib/mylib.h>
+#include <myshared/myshared.h>
 
 int main() {
   mylib::do_the_test();
+  return myshared::exit_code();
 }
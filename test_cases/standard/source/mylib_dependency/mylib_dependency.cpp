@@ -12,6 +12,15 @@ namespace mylib_dependency {
         mylib_dependency_resources_data_txt,
         mylib_dependency_resources_data_txt + mylib_dependency_resources_data_txt_len);
     std::cout << str;
+    // Left on the default encoding, an array.
+    std::cout << std::string(
+        mylib_dependency_resources_array_dat,
+        mylib_dependency_resources_array_dat + mylib_dependency_resources_array_dat_len);
+    std::cout << reinterpret_cast<const char *>(mylib_dependency_resources_string_txt);
+    const unsigned char *compressed = mylib_dependency_resources_compressed_txt_data();
+    if (compressed != 0) {
+      std::cout << std::string(compressed, compressed + mylib_dependency_resources_compressed_txt_len);
+    }
   }
 
 }
@@ -0,0 +1,9 @@
+#include "myshared.h"
+
+namespace myshared {
+
+  int exit_code() {
+    return 0;
+  }
+
+}
@@ -0,0 +1,7 @@
+#pragma once
+
+namespace myshared {
+
+  int exit_code();
+
+}